@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+AsyncSynergySession.py
+
+Keep many ccm commands in flight at once from a single Python process.
+
+AsyncSynergySessions is a SynergySessions pool with run_async(). The
+commands go to the worker threads of the pool, at most max_in_flight of
+them, each leasing a session of its own, so the commands in flight are
+spread over the sessions instead of queueing behind one CCM_ADDR. The
+number of commands running against one engine is further bounded by a
+semaphore shared by all sessions on that engine.
+
+AsyncSynergySession is a session whose run_async() hands the command set up
+by i.e. query() to such a pool, while run() runs it on the session itself.
+"""
+
+import threading
+import logging as logger
+
+from SynergySession import SynergySession
+from SynergySessions import SynergySessions
+from CommandFuture import CommandFuture, gather, CommandTimeoutException
+
+# engine -> BoundedSemaphore limiting the commands in flight against it
+_engine_semaphores = {}
+_engine_semaphores_lock = threading.Lock()
+
+def get_engine_semaphore(engine, max_in_flight):
+    """Get the semaphore of engine, the first caller decides its size"""
+    with _engine_semaphores_lock:
+        if engine not in _engine_semaphores:
+            _engine_semaphores[engine] = threading.BoundedSemaphore(max_in_flight)
+        return _engine_semaphores[engine]
+
+
+def run_command(ccm, command, format, hist, semaphore):
+    """Run the built command with ccm, a session of the pool, and parse its output by format"""
+    try:
+        with semaphore:
+            result = ccm._run(list(command))
+        if format is not None:
+            result = ccm._parse_output(result, format, hist)
+        return result
+    except Exception, e:
+        logger.warning("Command %s failed: %s" % (command, e))
+        raise
+
+
+class AsyncSynergySessions(SynergySessions):
+    """SynergySessions with run_async(), keeping up to max_in_flight commands in flight on as many sessions"""
+
+    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', nr_sessions=1, offline=False, channel=None,
+                 max_in_flight=16, **options):
+        self.max_in_flight = max_in_flight
+        self.semaphore = get_engine_semaphore(engine or database, max_in_flight)
+        options['max_sessions'] = max(options.get('max_sessions') or 0, max_in_flight)
+        super(AsyncSynergySessions, self).__init__(database, engine, command_name, ccm_ui_path, ccm_eng_path, nr_sessions, offline, channel, **options)
+
+    def __getstate__(self):
+        state = super(AsyncSynergySessions, self).__getstate__()
+        del state['semaphore']
+        return state
+
+    def __setstate__(self, state):
+        super(AsyncSynergySessions, self).__setstate__(state)
+        self.semaphore = get_engine_semaphore(self.engine or self.database, self.max_in_flight)
+
+    def run_async(self, command, format=None, hist=False, done_queue=None):
+        """Run the built command on a session of the pool, returns a CommandFuture
+
+        The result is parsed by format, see SynergySession._parse_output(). The
+        future is put on done_queue when the command has finished."""
+        return self.submit(run_command, command, format, hist, self.semaphore, done_queue=done_queue)
+
+    def session(self, ccm_addr=None):
+        """An AsyncSynergySession whose run_async() uses this pool"""
+        return AsyncSynergySession(self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, ccm_addr, self.offline,
+                                   self.max_in_flight, self.channel, pool=self)
+
+
+class AsyncSynergySession(SynergySession):
+    """SynergySession with run_async(), returning a CommandFuture instead of the result"""
+
+    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', ccm_addr=None, offline=False, max_in_flight=16,
+                 channel=None, pool=None):
+        # The semaphore is needed by the first command, run by SynergySession.__init__
+        self.engine = engine
+        self.database = database
+        self.max_in_flight = max_in_flight
+        self.semaphore = get_engine_semaphore(self.get_engine_key(), max_in_flight)
+        self.pool = pool
+        self.ccm_ui_path = ccm_ui_path
+        self.ccm_eng_path = ccm_eng_path
+        super(AsyncSynergySession, self).__init__(database, engine, command_name, ccm_ui_path, ccm_eng_path, ccm_addr, offline, channel)
+
+    def __getstate__(self):
+        state = super(AsyncSynergySession, self).__getstate__()
+        del state['semaphore']
+        state['pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.semaphore = get_engine_semaphore(self.get_engine_key(), self.max_in_flight)
+
+    def get_pool(self):
+        """The pool running the commands of run_async(), started with the first of them"""
+        if self.pool is None:
+            self.pool = AsyncSynergySessions(self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, offline=self.offline,
+                                             channel=self.channel_command, max_in_flight=self.max_in_flight)
+        return self.pool
+
+    def run_async(self, done_queue=None):
+        """
+        Start the Synergy command set by i.e. query() and return a CommandFuture.
+
+        The command runs on a session of the pool, see get_pool(). The future
+        is put on done_queue when the command has finished.
+        """
+        command = self._build_command()
+        formattable = 'formattable' in self.status and self.status['formattable']
+        format = None
+        if formattable:
+            format = list(self.status['format'])
+        hist = 'hist' in command
+        # Clean up, the command is fully described by command and format now
+        self._reset_status()
+        return self.get_pool().run_async(command, format, hist, done_queue)
+
+    def _execute(self, command):
+        with self.semaphore:
+            return super(AsyncSynergySession, self)._execute(command)
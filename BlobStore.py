@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+BlobStore.py
+
+Content addressed store of the sources in the ccm cache.
+
+Every distinct content is stored once, zlib compressed, in
+<blobs dir>/<sha[0:2]>/<sha[2:]>, where sha is the id git gives the content
+as a blob. The versions of a file which didn't change and copies of the
+same file in several instances share one blob, and ccm_fast_export knows the
+git id of a source without hashing it again.
+
+A compressed blob starts with ZLIB_HEADER and the length of the content,
+so open() knows the length up front and hands out the content as it is
+decompressed, in chunks of at most CHUNK_SIZE. Contents longer than
+raw_threshold which compress to more than RAW_RATIO of their size, mostly
+binaries, are stored uncompressed after RAW_HEADER, open() maps them into
+memory without copying. Blobs written before these headers are plain zlib
+data. Which blobs are stored is answered from a MembershipIndex.
+"""
+
+import os
+import zlib
+import mmap
+import struct
+import thread
+import hashlib
+
+from MembershipIndex import MembershipIndex, INDEX_FILENAME
+
+# Directory of the blobs in the ccm cache
+BLOBS_DIR = 'blobs'
+
+# Start of an uncompressed blob, zlib data starts with 0x78
+RAW_HEADER = 'RAWBLOB\0'
+
+# Start of a compressed blob, followed by the length of the content as 8 bytes
+ZLIB_HEADER = 'ZLIBLOB\0'
+LENGTH_FORMAT = '>Q'
+
+# Contents longer than this are stored uncompressed if they don't compress well
+DEFAULT_RAW_THRESHOLD = 1024 * 1024
+
+# Compressed to more than this part of their size they are stored uncompressed
+RAW_RATIO = 0.9
+
+# Largest chunk a compressed blob is handed out in
+CHUNK_SIZE = 256 * 1024
+
+
+def git_blob_sha(content):
+    """The id of content as a git blob object"""
+    m = hashlib.sha1()
+    m.update('blob %d\0' % len(content))
+    m.update(content)
+    return m.hexdigest()
+
+
+class BlobStore(object):
+    """Sources keyed by their git blob id, compressed with zlib"""
+
+    def __init__(self, path, level=6, raw_threshold=DEFAULT_RAW_THRESHOLD):
+        self.path = path
+        self.level = level
+        self.raw_threshold = raw_threshold
+        self.index = MembershipIndex(path, '', os.path.join(path, INDEX_FILENAME))
+
+    def get_path(self, sha):
+        dir = os.path.join(self.path, sha[0:2])
+        return dir, os.path.join(dir, sha[2:])
+
+    def exists(self, sha):
+        return self.index.contains(sha)
+
+    def get(self, sha):
+        """The content of blob sha, None if it isn't stored"""
+        opened = self.open(sha)
+        if opened is None:
+            return None
+        return ''.join([str(chunk) for chunk in opened[1]])
+
+    def open(self, sha):
+        """(length, chunks) of blob sha, None if it isn't stored
+
+        chunks can be iterated several times, the strings or buffers it
+        yields together are the content. An uncompressed blob is one buffer
+        on the memory mapped file, a compressed one is decompressed while it
+        is iterated, CHUNK_SIZE at a time"""
+        filename = self.get_path(sha)[1]
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            header = f.read(len(RAW_HEADER))
+            if header == RAW_HEADER:
+                return map_file(f, len(RAW_HEADER))
+            if header == ZLIB_HEADER:
+                length = struct.unpack(LENGTH_FORMAT, f.read(struct.calcsize(LENGTH_FORMAT)))[0]
+                if length <= CHUNK_SIZE:
+                    return length, [zlib.decompress(f.read())]
+                return length, DecompressedChunks(filename, f.tell())
+            # Written before the headers
+            content = zlib.decompress(header + f.read())
+        finally:
+            f.close()
+        return len(content), [content]
+
+    def put(self, content):
+        """Store content, returns its git blob id"""
+        sha = git_blob_sha(content)
+        dir, filename = self.get_path(sha)
+        if self.index.contains(sha):
+            return sha
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # just continue if it is already there
+                pass
+        # Write under a name of our own and rename, a reader never sees half a blob
+        tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), thread.get_ident())
+        compressed = zlib.compress(content, self.level)
+        f = open(tmp, 'wb')
+        if len(content) > self.raw_threshold and len(compressed) > RAW_RATIO * len(content):
+            f.write(RAW_HEADER)
+            f.write(content)
+        else:
+            f.write(ZLIB_HEADER)
+            f.write(struct.pack(LENGTH_FORMAT, len(content)))
+            f.write(compressed)
+        f.close()
+        os.rename(tmp, filename)
+        self.index.add(sha)
+        return sha
+
+    def save_index(self):
+        self.index.save()
+
+
+class DecompressedChunks(object):
+    """The content of the zlib data in filename from offset on, decompressed while it is iterated"""
+
+    def __init__(self, filename, offset):
+        self.filename = filename
+        self.offset = offset
+
+    def __iter__(self):
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(self.offset)
+            decompressor = zlib.decompressobj()
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                while data:
+                    chunk = decompressor.decompress(data, CHUNK_SIZE)
+                    if chunk:
+                        yield chunk
+                    data = decompressor.unconsumed_tail
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            f.close()
+
+
+def map_file(f, offset=0):
+    """(length, [buffer]) of the content of the open file f from offset on, memory mapped"""
+    length = os.fstat(f.fileno()).st_size - offset
+    if length <= 0:
+        return 0, []
+    # The map keeps its own handle of the file, and lives as long as the buffer
+    content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return length, [buffer(content, offset)]
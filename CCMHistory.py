@@ -168,14 +168,14 @@ class CCMHistory(object):
         if not self.baseline_objects:
             self.baseline_objects = baseline_project.get_members()
             if self.baseline_objects is None or len(self.baseline_objects) == 1 or not isinstance(self.baseline_objects, dict):
-                self.baseline_objects = ccm_objects.get_objects_in_project(baseline_project.get_object_name(), ccmpool=self.ccmpool)
+                self.baseline_objects = ccm_objects.get_objects_in_project(baseline_project.get_object_name(), ccm=self.ccm, ccmpool=self.ccmpool)
                 baseline_project.set_members(self.baseline_objects)
                 ccm_cache.force_cache_update_for_object(baseline_project)
         if next_project:
             # Get all objects and paths for next project
             self.project_objects = next_project.get_members()
             if self.project_objects is None or len(self.project_objects) == 1  or not isinstance(self.project_objects, dict):
-                self.project_objects = ccm_objects.get_objects_in_project(next_project.get_object_name(), ccmpool=self.ccmpool)
+                self.project_objects = ccm_objects.get_objects_in_project(next_project.get_object_name(), ccm=self.ccm, ccmpool=self.ccmpool)
                 next_project.set_members(self.project_objects)
                 ccm_cache.force_cache_update_for_object(next_project)
             # Find difference between baseline_project and next_project
@@ -205,8 +205,16 @@ class CCMHistory(object):
 
         object_names = set([o for o in new_objects.keys() if ':project:' not in o]) - set(objects)
 
+        # Get all the objects at once, so the ones missing in the cache are queried in batches
+        ccm_cache.prefetch(object_names, self.ccmpool)
+        fetched = ccm_cache.get_objects(object_names, self.ccm)
+        if next_project:
+            # The history of every object starts with its predecessors
+            ccm_cache.prefetch([p for o in fetched.values() for p in o.predecessors], self.ccmpool)
         for o in object_names:
-            object = ccm_cache.get_object(o, self.ccm)
+            object = fetched.get(o)
+            if object is None:
+                object = ccm_cache.get_object(o, self.ccm)
             if next_project:
                 # get the object history between releases
                 history = object_history.get_history(object, new_objects[object.get_object_name()])
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cassette.py
+
+Record the ccm commands of a run with their output and latency, and replay
+them later without a Synergy server.
+
+A cassette file is a sequence of records, each a 4 byte length followed by a
+zlib compressed pickle of (database, arguments, stdout, stderr, latency).
+The database is the name of the database, not its path, and the arguments
+leave out the ccm executable, so a cassette can be replayed anywhere. Every
+record is appended with a single write, so several processes can record
+into one cassette.
+"""
+
+import os
+import time
+import zlib
+import struct
+import cPickle
+import threading
+import logging as logger
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class Cassette(object):
+    """Recorder or player of ccm command responses"""
+
+    def __init__(self, filename, mode, replay_latency=False):
+        if mode not in (RECORD, REPLAY):
+            raise CassetteException("Unknown cassette mode %s" % mode)
+        self.filename = filename
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.lock = threading.Lock()
+        # (database, arguments) -> [(stdout, stderr, latency)] in recorded order
+        self.responses = {}
+        self.positions = {}
+        if mode == REPLAY:
+            self.load()
+
+    def is_recording(self):
+        return self.mode == RECORD
+
+    def is_replaying(self):
+        return self.mode == REPLAY
+
+    def record(self, database, args, stdout, stderr, latency):
+        data = zlib.compress(cPickle.dumps((database, list(args), stdout, stderr, latency), cPickle.HIGHEST_PROTOCOL))
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, struct.pack('>I', len(data)) + data)
+        finally:
+            os.close(fd)
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            raise CassetteException("Cassette %s doesn't exist" % self.filename)
+        f = open(self.filename, 'rb')
+        count = 0
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            length = struct.unpack('>I', header)[0]
+            data = f.read(length)
+            if len(data) < length:
+                logger.warning("Cassette %s ends with a truncated record" % self.filename)
+                break
+            database, args, stdout, stderr, latency = cPickle.loads(zlib.decompress(data))
+            self.responses.setdefault((database, tuple(args)), []).append((stdout, stderr, latency))
+            count += 1
+        f.close()
+        logger.info("Loaded %d ccm responses from cassette %s" % (count, self.filename))
+
+    def replay(self, database, args):
+        """The recorded (stdout, stderr) of args on database
+
+        Repeated commands get their responses in recorded order, the last one
+        is repeated once they run out."""
+        key = (database, tuple(args))
+        with self.lock:
+            if key not in self.responses:
+                raise CassetteException("Command %s on %s is not in cassette %s" % (' '.join(args), database, self.filename))
+            responses = self.responses[key]
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            stdout, stderr, latency = responses[min(position, len(responses) - 1)]
+        if self.replay_latency and latency:
+            time.sleep(latency)
+        return stdout, stderr
+
+
+_cassette = None
+
+def get_cassette():
+    """The cassette of this process, None when neither recording nor replaying"""
+    return _cassette
+
+def set_cassette(cassette):
+    global _cassette
+    _cassette = cassette
+
+def configure_cassette(config):
+    """Set up the cassette from the ccm_cassette* keys of the configuration"""
+    if config.get('ccm_cassette'):
+        set_cassette(Cassette(config['ccm_cassette'], config.get('ccm_cassette_mode') or RECORD,
+                              config.get('ccm_cassette_latency', False)))
+
+
+class CassetteException(Exception):
+    """User defined exception raised by Cassette"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CommandChannel.py
+
+Stream ccm commands through one long lived helper process instead of
+starting a new process for every command.
+
+Protocol (all lengths are byte counts):
+
+    request:  "<length>\\n" followed by the command arguments joined by '\\0'
+    response: "<returncode> <stdout length> <stderr length>\\n" followed by
+              stdout and stderr
+
+A request of length 0 asks the helper to shut down.
+"""
+
+import sys
+from subprocess import Popen, PIPE
+
+
+class CommandChannel(object):
+    """Client side of a framed command channel to a helper process"""
+
+    def __init__(self, command, env):
+        self.command = command
+        self.process = Popen(command, stdin=PIPE, stdout=PIPE, env=env)
+
+    def execute(self, args):
+        """Send one command to the helper and return (returncode, stdout, stderr)"""
+        payload = '\0'.join(args)
+        try:
+            self.process.stdin.write('%d\n%s' % (len(payload), payload))
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+        except (IOError, OSError), e:
+            raise CommandChannelException('Channel %s failed: %s' % (self.command, e))
+        if not header:
+            raise CommandChannelException('Channel %s closed unexpectedly' % self.command)
+        try:
+            returncode, stdout_len, stderr_len = [int(i) for i in header.split()]
+        except ValueError:
+            raise CommandChannelException('Malformed response header from %s: %r' % (self.command, header))
+        stdout = self._read(stdout_len)
+        stderr = self._read(stderr_len)
+        return returncode, stdout, stderr
+
+    def _read(self, length):
+        data = self.process.stdout.read(length)
+        if len(data) != length:
+            raise CommandChannelException('Channel %s closed unexpectedly' % self.command)
+        return data
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        """Ask the helper to exit and reap it"""
+        if self.is_alive():
+            try:
+                self.process.stdin.write('0\n')
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.process.wait()
+
+
+def serve(handler, stdin=None, stdout=None):
+    """Server side of the channel: read requests and answer them with handler(args)
+
+    handler must return a (returncode, stdout, stderr) tuple."""
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        length = int(header)
+        if not length:
+            break
+        args = stdin.read(length).split('\0')
+        returncode, out, err = handler(args)
+        stdout.write('%d %d %d\n' % (returncode, len(out), len(err)))
+        stdout.write(out)
+        stdout.write(err)
+        stdout.flush()
+
+
+class CommandChannelException(Exception):
+    """User defined exception raised by CommandChannel"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
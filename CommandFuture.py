@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CommandFuture.py
+
+The pending result of a ccm command, or of a function run with a session
+of a pool, which is done on another thread.
+"""
+
+import threading
+
+
+class CommandFuture(object):
+    """The pending result of a command started by run_async() or SynergySessions.submit()"""
+
+    def __init__(self, command, done_queue=None):
+        self.command = command
+        self.done_queue = done_queue
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done.set()
+        if self.done_queue is not None:
+            self.done_queue.put(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the command and return its result, or raise its exception"""
+        if not self._done.wait(timeout):
+            raise CommandTimeoutException("Command %s didn't finish within %s s" % (self.command, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def gather(futures, timeout=None):
+    """Wait for all futures and return their results in the same order"""
+    return [f.result(timeout) for f in futures]
+
+
+class CommandTimeoutException(Exception):
+    """User defined exception raised by CommandFuture"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CommandMemo.py
+
+Remember the output of ccm commands whose answer can't change during a run,
+per database, so repeating them costs nothing.
+
+Only the command classes listed in CACHEABLE_COMMANDS are remembered. The
+memo is shared by all sessions of the process and can be persisted to a
+file between runs.
+"""
+
+import os
+import cPickle
+import threading
+import logging as logger
+
+def _is_delim(args):
+    return args == ['delim']
+
+def _is_type_query(args):
+    return args[0] == 'query' and args[-1] == "type='attype'"
+
+# (class name, predicate on the command arguments without the command name)
+CACHEABLE_COMMANDS = [
+    ('delim', _is_delim),
+    ('type_query', _is_type_query),
+]
+
+
+class CommandMemo(object):
+    """Output of cacheable ccm commands, keyed by database and command arguments"""
+
+    def __init__(self):
+        self.results = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def get_class(self, args):
+        """The cacheable command class of args, None if the command isn't cacheable"""
+        if not args:
+            return None
+        for name, predicate in CACHEABLE_COMMANDS:
+            if predicate(args):
+                return name
+        return None
+
+    def is_cacheable(self, args):
+        return self.get_class(args) is not None
+
+    def lookup(self, database, args):
+        """The remembered output of args on database, or None"""
+        command_class = self.get_class(args)
+        if command_class is None:
+            return None
+        with self.lock:
+            result = self.results.get((database, tuple(args)))
+            if result is None:
+                self.misses[command_class] = self.misses.get(command_class, 0) + 1
+            else:
+                self.hits[command_class] = self.hits.get(command_class, 0) + 1
+            return result
+
+    def store(self, database, args, stdout):
+        if self.is_cacheable(args):
+            with self.lock:
+                self.results[(database, tuple(args))] = stdout
+
+    def clear(self):
+        with self.lock:
+            self.results = {}
+
+    def get_metrics(self):
+        with self.lock:
+            return {'entries': len(self.results), 'hits': dict(self.hits), 'misses': dict(self.misses)}
+
+    def load(self, filename):
+        """Add the results persisted in filename, if it exists"""
+        if not os.path.isfile(filename):
+            return
+        try:
+            f = open(filename, 'rb')
+            results = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            logger.warning("Couldn't load ccm command memo %s: %s" % (filename, e))
+            return
+        with self.lock:
+            self.results.update(results)
+        logger.info("Loaded %d ccm command results from %s" % (len(results), filename))
+
+    def save(self, filename):
+        with self.lock:
+            results = dict(self.results)
+        f = open(filename + '.tmp', 'wb')
+        cPickle.dump(results, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(filename + '.tmp', filename)
+
+
+_memo = CommandMemo()
+
+def get_command_memo():
+    """The memo shared by all sessions of this process"""
+    return _memo
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+CommandStats.py
+
+Count the ccm commands run, per kind of command: calls, retries, errors,
+memo hits, wall time with a histogram, and bytes of output.
+
+The kind is the ccm command, refined by the query function for queries
+(i.e. 'query is_child_of') and by the option for attr (i.e. 'attr -s').
+
+Every process keeps its own statistics. The session pools run their commands
+in worker processes, so start_command_stats() sets up a spool directory the
+workers write their statistics to when they exit, and collect_command_stats()
+adds them up in the process that started it.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import cPickle
+import tempfile
+import threading
+import logging as logger
+from multiprocessing import util
+
+# Upper bounds in seconds of the buckets of the wall time histogram, the last bucket is unbounded
+HISTOGRAM_BOUNDS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+def get_command_kind(args):
+    """The kind of the ccm command args, without the command name"""
+    if not args:
+        return 'none'
+    kind = args[0]
+    if kind == 'query':
+        m = re.match('[\s(]*(\w+)\(', args[-1])
+        if m:
+            kind += ' ' + m.group(1)
+    elif kind == 'attr':
+        for option in ('-s', '-la', '-l', '-c', '-m'):
+            if option in args:
+                kind += ' ' + option
+                break
+    return kind
+
+
+class CommandStats(object):
+    """Statistics of the ccm commands run by one process"""
+
+    def __init__(self):
+        # kind -> counters
+        self.kinds = {}
+        self.lock = threading.Lock()
+
+    def _get_kind(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {'calls': 0,
+                                'retries': 0,
+                                'errors': 0,
+                                'memo_hits': 0,
+                                'time': 0.0,
+                                'max_time': 0.0,
+                                'stdout_bytes': 0,
+                                'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1)}
+        return self.kinds[kind]
+
+    def record(self, kind, elapsed, stdout_bytes, retries=0, error=False):
+        bucket = len(HISTOGRAM_BOUNDS)
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if elapsed <= bound:
+                bucket = i
+                break
+        with self.lock:
+            counters = self._get_kind(kind)
+            counters['calls'] += 1
+            counters['retries'] += retries
+            if error:
+                counters['errors'] += 1
+            counters['time'] += elapsed
+            counters['max_time'] = max(counters['max_time'], elapsed)
+            counters['stdout_bytes'] += stdout_bytes
+            counters['histogram'][bucket] += 1
+
+    def record_memo_hit(self, kind):
+        with self.lock:
+            self._get_kind(kind)['memo_hits'] += 1
+
+    def merge(self, kinds):
+        """Add the counters of kinds, as returned by get_kinds()"""
+        with self.lock:
+            for kind, other in kinds.iteritems():
+                counters = self._get_kind(kind)
+                for k in ('calls', 'retries', 'errors', 'memo_hits', 'time', 'stdout_bytes'):
+                    counters[k] += other[k]
+                counters['max_time'] = max(counters['max_time'], other['max_time'])
+                counters['histogram'] = [a + b for a, b in zip(counters['histogram'], other['histogram'])]
+
+    def get_kinds(self):
+        with self.lock:
+            return dict([(kind, dict(counters, histogram=list(counters['histogram']))) for kind, counters in self.kinds.iteritems()])
+
+    def get_report(self):
+        """The statistics per kind and in total, slowest kinds first, with readable histograms"""
+        kinds = self.get_kinds()
+        labels = ['<=%gs' % b for b in HISTOGRAM_BOUNDS] + ['>%gs' % HISTOGRAM_BOUNDS[-1]]
+        total = {'calls': 0, 'retries': 0, 'errors': 0, 'memo_hits': 0, 'time': 0.0, 'stdout_bytes': 0}
+        report = []
+        for kind, counters in sorted(kinds.iteritems(), key=lambda (k, c): c['time'], reverse=True):
+            for k in total.keys():
+                total[k] += counters[k]
+            entry = dict(counters)
+            entry['kind'] = kind
+            entry['mean_time'] = counters['calls'] and counters['time'] / counters['calls']
+            entry['histogram'] = dict([(label, n) for label, n in zip(labels, counters['histogram']) if n])
+            report.append(entry)
+        return {'total': total, 'kinds': report}
+
+
+_stats = None
+_stats_pid = None
+_stats_lock = threading.Lock()
+# Directory the worker processes spool their statistics to, and the process collecting them
+_spool = None
+_spool_owner = None
+
+def get_command_stats():
+    """The statistics of this process, a forked process starts with empty ones"""
+    global _stats, _stats_pid
+    with _stats_lock:
+        if _stats_pid != os.getpid():
+            _stats = CommandStats()
+            _stats_pid = os.getpid()
+            if _spool and _spool_owner != _stats_pid:
+                util.Finalize(None, _spool_command_stats, exitpriority=10)
+        return _stats
+
+def _spool_command_stats():
+    if _stats_pid != os.getpid() or not _stats.kinds or not os.path.isdir(_spool):
+        return
+    fd, filename = tempfile.mkstemp(prefix='stats-%d-' % os.getpid(), suffix='.p', dir=_spool)
+    f = os.fdopen(fd, 'wb')
+    cPickle.dump(_stats.get_kinds(), f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+
+def start_command_stats():
+    """Collect the statistics of the processes forked from now on"""
+    global _spool, _spool_owner
+    if _spool is None:
+        _spool = tempfile.mkdtemp(prefix='ccm_stats-')
+        _spool_owner = os.getpid()
+
+def collect_command_stats():
+    """The statistics of this process and of the exited worker processes, as a CommandStats"""
+    stats = CommandStats()
+    stats.merge(get_command_stats().get_kinds())
+    if _spool and os.path.isdir(_spool):
+        for filename in os.listdir(_spool):
+            try:
+                f = open(os.path.join(_spool, filename), 'rb')
+                stats.merge(cPickle.load(f))
+                f.close()
+            except (IOError, EOFError, cPickle.UnpicklingError), e:
+                logger.warning("Couldn't load ccm command statistics %s: %s" % (filename, e))
+    return stats
+
+def write_command_stats_report(filename, extra=None):
+    """Write the collected statistics, and the entries of extra, as JSON to filename"""
+    report = collect_command_stats().get_report()
+    report['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    if extra:
+        report.update(extra)
+    f = open(filename, 'w')
+    json.dump(report, f, indent=2, sort_keys=True)
+    f.close()
+    if _spool and _spool_owner == os.getpid():
+        shutil.rmtree(_spool, ignore_errors=True)
+    logger.info("ccm command statistics written to %s" % filename)
+    return report
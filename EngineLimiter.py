@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+EngineLimiter.py
+
+Pace the ccm commands sent to one Synergy engine.
+
+Commands run unthrottled until ccm reports contention on stderr. The
+limiter then switches to a token bucket, halving its rate on every further
+contention error and raising it a little on every success until it is back
+above max_rate and unthrottled again. Other failures are retried after an
+exponential backoff. The time spent waiting is kept as metrics.
+"""
+
+import re
+import time
+import random
+import threading
+
+# stderr of ccm matching one of these means the engine is overloaded rather than the command wrong
+CONTENTION_PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
+    'engine.*busy',
+    'too many',
+    'connection refused',
+    'unable to connect',
+    'timed? ?out',
+    'communication (error|failure)',
+    'server.*not responding',
+    'try again',
+]]
+
+# engine -> EngineLimiter
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_engine_limiter(engine):
+    with _limiters_lock:
+        if engine not in _limiters:
+            _limiters[engine] = EngineLimiter()
+        return _limiters[engine]
+
+def get_limiter_metrics():
+    """Metrics of all engine limiters in this process: {engine: metrics}"""
+    with _limiters_lock:
+        return dict([(engine, limiter.get_metrics()) for engine, limiter in _limiters.iteritems()])
+
+
+class EngineLimiter(object):
+    """Adaptive token bucket for the commands sent to one engine"""
+
+    def __init__(self, initial_rate=10.0, min_rate=0.5, max_rate=50.0, rate_increase=0.1, backoff_base=0.2, backoff_max=10.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_increase = rate_increase
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Commands per second, None while unthrottled
+        self.rate = None
+        self.tokens = 0.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+        self.commands = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.contentions = 0
+        self.failures = 0
+        self.backoff_time = 0.0
+
+    def acquire(self):
+        """Wait for the next free slot, returns the time waited"""
+        with self.lock:
+            self.commands += 1
+            if self.rate is None:
+                return 0.0
+            now = time.time()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Reserve the token right away, concurrent callers queue up behind it
+            self.tokens -= 1.0
+            wait = 0.0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.waits += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def success(self):
+        with self.lock:
+            if self.rate is not None:
+                self.rate += self.rate_increase
+                if self.rate > self.max_rate:
+                    self.rate = None
+
+    def is_contention(self, stderr):
+        for p in CONTENTION_PATTERNS:
+            if p.search(stderr):
+                return True
+        return False
+
+    def failure(self, stderr, retrycount):
+        """Register a failed command, slowing down on contention and backing off otherwise"""
+        if self.is_contention(stderr):
+            with self.lock:
+                self.contentions += 1
+                if self.rate is None:
+                    self.rate = self.initial_rate
+                    self.tokens = 0.0
+                    self.last = time.time()
+                else:
+                    self.rate = max(self.min_rate, self.rate / 2)
+        else:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** retrycount) * (0.5 + random.random() / 2)
+            with self.lock:
+                self.failures += 1
+                self.backoff_time += delay
+            time.sleep(delay)
+
+    def get_metrics(self):
+        with self.lock:
+            return {'commands': self.commands,
+                    'rate': self.rate,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'max_wait': self.max_wait,
+                    'contentions': self.contentions,
+                    'failures': self.failures,
+                    'backoff_time': self.backoff_time}
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+MembershipIndex.py
+
+Know which files a sharded cache directory holds without asking the file
+system, which costs a round trip per stat on NFS.
+
+The files are named after a sha1, in <path>/<sha[0:2]>/<rest of sha>. The
+index keeps the first 60 bits of the sha of every file in memory, one set
+per shard directory, and is saved in filename together with the mtime of
+each directory. Loading it stats the directories, several at once, and
+lists again only those which changed since. The owner adds and discards
+the files it writes and deletes. Files other processes write later are not
+seen, a caller which must know looks on the disk.
+"""
+
+import os
+import time
+import marshal
+import tempfile
+import threading
+import logging as logger
+from multiprocessing.pool import ThreadPool
+
+# Name of the index file of the meta data and of the blob stores
+INDEX_FILENAME = 'membership.idx'
+
+INDEX_VERSION = 1
+
+# Directories statted and listed at once
+DEFAULT_THREADS = 16
+
+# A directory changed this recently may change again within its mtime's resolution
+MTIME_SLACK = 2
+
+
+def get_key(sha):
+    return int(sha[0:15], 16)
+
+
+class MembershipIndex(object):
+    """The files in the shard directories of path, those ending with suffix"""
+
+    def __init__(self, path, suffix='', filename=None, threads=DEFAULT_THREADS):
+        self.path = path
+        self.suffix = suffix
+        self.filename = filename
+        self.threads = threads
+        self.lock = threading.Lock()
+        # shard -> set of keys of the files in it
+        self.shards = None
+        # shard -> mtime of the directory when it was listed, None to list it again
+        self.mtimes = {}
+        self.changed = False
+        self.relisted = 0
+
+    def contains(self, sha):
+        shards = self.shards or self.load()
+        return get_key(sha) in shards.get(sha[0:2], ())
+
+    def add(self, sha):
+        shards = self.shards or self.load()
+        with self.lock:
+            keys = shards.setdefault(sha[0:2], set())
+            if get_key(sha) not in keys:
+                keys.add(get_key(sha))
+                self.changed = True
+
+    def discard(self, sha):
+        shards = self.shards or self.load()
+        with self.lock:
+            keys = shards.get(sha[0:2])
+            if keys is not None and get_key(sha) in keys:
+                keys.discard(get_key(sha))
+                self.changed = True
+
+    def load(self):
+        """Read the saved index and list the directories changed since, returns the shards"""
+        with self.lock:
+            if self.shards is not None:
+                return self.shards
+            start = time.time()
+            saved = self._read()
+            try:
+                dirs = [dir for dir in os.listdir(self.path) if len(dir) == 2]
+            except OSError:
+                dirs = []
+            pool = ThreadPool(self.threads)
+            mtimes = dict(zip(dirs, pool.map(self._get_mtime, dirs)))
+            stale = [dir for dir in dirs if mtimes[dir] is not None and
+                     (dir not in saved or saved[dir][0] is None or saved[dir][0] != mtimes[dir])]
+            listed = dict(zip(stale, pool.map(self._list, stale)))
+            pool.close()
+            pool.join()
+
+            shards = {}
+            for dir in dirs:
+                if dir in listed:
+                    self.mtimes[dir], shards[dir] = listed[dir]
+                elif dir in saved:
+                    self.mtimes[dir] = saved[dir][0]
+                    shards[dir] = set(saved[dir][1])
+            self.relisted = len(stale)
+            self.changed = bool(stale) or len(saved) != len(shards)
+            self.shards = shards
+            logger.info("Loaded the index of %d files in %s, listed %d of %d directories in %.1f s"
+                        % (sum([len(keys) for keys in shards.values()]), self.path, len(stale), len(dirs), time.time() - start))
+            return shards
+
+    def _read(self):
+        """{shard: (mtime, [keys])} as saved, empty if there is no usable index"""
+        if not self.filename or not os.path.isfile(self.filename):
+            return {}
+        try:
+            f = open(self.filename, 'rb')
+            version, shards = marshal.load(f)
+            f.close()
+        except (IOError, EOFError, ValueError, TypeError), e:
+            logger.warning("Couldn't load index %s: %s" % (self.filename, e))
+            return {}
+        if version != INDEX_VERSION:
+            return {}
+        return shards
+
+    def _get_mtime(self, dir):
+        try:
+            return os.stat(os.path.join(self.path, dir)).st_mtime
+        except OSError:
+            return None
+
+    def _list(self, dir):
+        """(mtime, keys) of the files in dir"""
+        path = os.path.join(self.path, dir)
+        mtime = self._get_mtime(dir)
+        keys = set()
+        for filename in os.listdir(path):
+            # Temporary files have a '.' in their names
+            if filename.endswith(self.suffix) and '.' not in filename:
+                keys.add(get_key(dir + filename))
+        if mtime is None or time.time() - mtime < MTIME_SLACK:
+            # Files may still be added within the resolution of the mtime
+            mtime = None
+        return mtime, keys
+
+    def save(self):
+        """Store the index in filename, if it changed"""
+        if not self.filename or not self.changed or self.shards is None:
+            return
+        with self.lock:
+            shards = dict([(dir, (self.mtimes.get(dir), list(keys))) for dir, keys in self.shards.items()])
+            self.changed = False
+        # The directories written since they were listed must be listed again, as others may have written as well
+        for dir in shards.keys():
+            if self._get_mtime(dir) != shards[dir][0]:
+                shards[dir] = (None, shards[dir][1])
+        # A file of our own, other threads and processes may be saving as well
+        fd, tmp = tempfile.mkstemp('.tmp', os.path.basename(self.filename) + '.', os.path.dirname(self.filename) or '.')
+        f = os.fdopen(fd, 'wb')
+        marshal.dump((INDEX_VERSION, shards), f, 2)
+        f.close()
+        os.rename(tmp, self.filename)
+
+    def get_metrics(self):
+        shards = self.shards or {}
+        return {'files': sum([len(keys) for keys in shards.values()]), 'directories': len(shards),
+                'relisted': self.relisted}
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+MetadataStore.py
+
+Backends storing the meta data objects of the ccm cache, keyed by their
+four-part name.
+
+FileMetadataStore is the original layout, one file per object in a
+directory named after the sha1 of the name. SqliteMetadataStore keeps all
+objects in one SQLite database: writes are buffered and committed in
+batches, and a list of names is read with a single indexed query. Both
+store the objects encoded by ObjectCodec and read pickles written before.
+The file store knows which objects it has from a MembershipIndex, the
+SQLite store from the database.
+"""
+
+import os
+import time
+import hashlib
+import thread
+import sqlite3
+import threading
+import logging as logger
+from multiprocessing import util
+
+from ObjectCodec import encode, decode
+from MembershipIndex import MembershipIndex, INDEX_FILENAME
+
+BACKENDS = ['files', 'sqlite']
+
+# Name of the SQLite database in the cache directory
+SQLITE_FILENAME = 'metadata.db'
+
+
+class FileMetadataStore(object):
+    """One <sha[0:2]>/<sha[2:-1]>_data file per object
+
+    Which objects are there is answered from a MembershipIndex, only reading
+    an object goes to the disk"""
+
+    def __init__(self, ccm_cache_path):
+        self.ccm_cache_path = ccm_cache_path
+        self.index = MembershipIndex(ccm_cache_path, '_data', os.path.join(ccm_cache_path, INDEX_FILENAME))
+
+    def get_sha(self, name):
+        m = hashlib.sha1()
+        m.update(name)
+        return m.hexdigest()
+
+    def get_path(self, name):
+        sha = self.get_sha(name)
+        dir = self.ccm_cache_path + sha[0:2]
+        return dir, dir + '/' + sha[2:-1] + '_data'
+
+    def get(self, name):
+        dir, datafile = self.get_path(name)
+        try:
+            f = open(datafile, 'rb')
+        except IOError:
+            # Not in the cache, or deleted since
+            self.index.discard(self.get_sha(name))
+            return None
+        data = f.read()
+        f.close()
+        self.index.add(self.get_sha(name))
+        return decode(data)
+
+    def get_many(self, names, refresh=False):
+        """The objects of names in the store, {name: object}
+
+        Only the objects in the index are read, with refresh the others are
+        looked for as well, they may have been written by other processes"""
+        result = {}
+        for name in names:
+            if not refresh and not self.exists(name):
+                continue
+            object_data = self.get(name)
+            if object_data is not None:
+                result[name] = object_data
+        return result
+
+    def exists(self, name):
+        return self.index.contains(self.get_sha(name))
+
+    def existing(self, names):
+        return set([name for name in names if self.exists(name)])
+
+    def put(self, object):
+        dir, datafile = self.get_path(object.get_object_name())
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # just continue if it is already there
+                pass
+        # Write under a name of our own and rename over the old file, a reader never sees half an object
+        tmp = '%s.%d.%d.tmp' % (datafile, os.getpid(), thread.get_ident())
+        f = open(tmp, 'wb')
+        f.write(encode(object))
+        f.close()
+        os.rename(tmp, datafile)
+        self.index.add(self.get_sha(object.get_object_name()))
+
+    def delete(self, name):
+        self.index.discard(self.get_sha(name))
+        try:
+            os.remove(self.get_path(name)[1])
+        except OSError:
+            # Not in the cache, or deleted by another process
+            pass
+
+    def flush(self):
+        """The objects are written as they are put, nothing is buffered"""
+        pass
+
+    def save_index(self):
+        """Save the index, once at the end of a run, it is rewritten as a whole"""
+        self.index.save()
+
+    def iter_objects(self):
+        """All objects of the store, in no particular order"""
+        for dir in sorted(os.listdir(self.ccm_cache_path)):
+            path = os.path.join(self.ccm_cache_path, dir)
+            if len(dir) != 2 or not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                if filename.endswith('_data'):
+                    f = open(os.path.join(path, filename), 'rb')
+                    data = f.read()
+                    f.close()
+                    yield decode(data)
+
+
+class SqliteMetadataStore(object):
+    """All objects in one table of an SQLite database"""
+
+    def __init__(self, filename, batch_size=500):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        # name -> encoded object written but not committed yet, None for a deletion
+        self.pending = {}
+        self.connection = None
+        self.pid = None
+
+    def _connect(self):
+        """The connection of this process, a forked process opens its own"""
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.filename, timeout=300, check_same_thread=False)
+            self.connection.text_factory = str
+            self.connection.execute('CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY, data BLOB NOT NULL)')
+            self.connection.commit()
+            # The writes buffered by the parent are the parent's to commit
+            self.pending = {}
+            self.pid = os.getpid()
+            util.Finalize(None, self.flush, exitpriority=20)
+        return self.connection
+
+    def get(self, name):
+        return self.get_many([name]).get(name)
+
+    def get_many(self, names, refresh=False):
+        """The objects of names found in the store, {name: object}, read with one query
+
+        The database is always current, refresh is for the file store"""
+        result = {}
+        with self.lock:
+            connection = self._connect()
+            wanted = []
+            for name in set(names):
+                if name in self.pending:
+                    if self.pending[name] is not None:
+                        result[name] = decode(self.pending[name])
+                else:
+                    wanted.append(name)
+            if not wanted:
+                return result
+            rows = self._select(connection, 'objects.name, objects.data', wanted)
+        for name, data in rows:
+            result[name] = decode(str(data))
+        return result
+
+    def _select(self, connection, columns, names):
+        """The rows of names in objects, one query"""
+        if len(names) == 1:
+            return connection.execute('SELECT %s FROM objects WHERE name = ?' % columns, names).fetchall()
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (name TEXT PRIMARY KEY)')
+        connection.execute('DELETE FROM wanted')
+        connection.executemany('INSERT INTO wanted VALUES (?)', [(name,) for name in names])
+        rows = connection.execute('SELECT %s FROM wanted JOIN objects ON objects.name = wanted.name' % columns).fetchall()
+        connection.commit()
+        return rows
+
+    def exists(self, name):
+        with self.lock:
+            if name in self.pending:
+                return self.pending[name] is not None
+            connection = self._connect()
+            return connection.execute('SELECT 1 FROM objects WHERE name = ?', (name,)).fetchone() is not None
+
+    def existing(self, names):
+        """The names of names in the store, read with one query"""
+        result = set()
+        with self.lock:
+            connection = self._connect()
+            wanted = []
+            for name in set(names):
+                if name in self.pending:
+                    if self.pending[name] is not None:
+                        result.add(name)
+                else:
+                    wanted.append(name)
+            if wanted:
+                result.update([name for (name,) in self._select(connection, 'objects.name', wanted)])
+        return result
+
+    def put(self, object):
+        with self.lock:
+            self._connect()
+            self.pending[object.get_object_name()] = encode(object)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def delete(self, name):
+        with self.lock:
+            self._connect()
+            self.pending[name] = None
+            self.flush()
+
+    def flush(self):
+        """Commit the buffered writes in one transaction"""
+        with self.lock:
+            if not self.pending or self.pid != os.getpid():
+                return
+            connection = self._connect()
+            puts = [(name, sqlite3.Binary(data)) for name, data in self.pending.iteritems() if data is not None]
+            deletes = [(name,) for name, data in self.pending.iteritems() if data is None]
+            start = time.time()
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO objects (name, data) VALUES (?, ?)', puts)
+                connection.executemany('DELETE FROM objects WHERE name = ?', deletes)
+            logger.debug("Committed %d objects to %s in %.2f s" % (len(self.pending), self.filename, time.time() - start))
+            self.pending = {}
+
+    def save_index(self):
+        """The database is its own index"""
+        pass
+
+    def iter_objects(self, chunk_size=1000):
+        for rows in self.iter_raw(chunk_size):
+            for name, data in rows:
+                yield decode(data)
+
+    def iter_raw(self, chunk_size=1000):
+        """All objects of the store as lists of at most chunk_size (name, encoded object)"""
+        self.flush()
+        last = 0
+        while True:
+            with self.lock:
+                rows = self._connect().execute('SELECT rowid, name, data FROM objects WHERE rowid > ? ORDER BY rowid LIMIT ?', (last, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield [(name, str(data)) for rowid, name, data in rows]
+            last = rows[-1][0]
+
+    def put_raw(self, rows):
+        """Store the encoded objects of rows, (name, data), in one transaction"""
+        with self.lock:
+            self.flush()
+            with self._connect() as connection:
+                connection.executemany('INSERT OR REPLACE INTO objects (name, data) VALUES (?, ?)', [(name, sqlite3.Binary(data)) for name, data in rows])
+
+
+def create_metadata_store(backend, ccm_cache_path):
+    if backend in (None, '', 'files'):
+        return FileMetadataStore(ccm_cache_path)
+    if backend == 'sqlite':
+        return SqliteMetadataStore(os.path.join(ccm_cache_path, SQLITE_FILENAME))
+    raise MetadataStoreException("Unknown cache backend %s, use one of %s" % (backend, ', '.join(BACKENDS)))
+
+
+class MetadataStoreException(Exception):
+    """User defined exception raised by the metadata stores"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
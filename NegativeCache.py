@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+NegativeCache.py
+
+Remember the objects Synergy couldn't return, so asking for them again
+costs a dictionary lookup instead of a round of ccm queries.
+
+Every entry has a reason code, the error message, how often it was asked
+for and when it was first and last recorded. Objects which weren't found
+expire after ttl seconds, failed queries, often transient engine errors,
+after failed_ttl seconds; the object is asked from Synergy again then.
+Only the query of a single object is recorded, a failing batch is split
+by ccm_cache first. The entries are kept
+in a pickle in the ccm cache, next to the meta data, and merged with the
+ones other processes saved.
+
+    NegativeCache.py        list the objects which couldn't be fetched
+"""
+
+import os
+import time
+import cPickle
+import threading
+import logging as logger
+
+# Name of the file in the ccm cache
+NEGATIVE_CACHE_FILENAME = 'negative.p'
+
+# Reason codes
+QUERY_FAILED = 'query_failed'       # the query of the object failed
+NOT_FOUND = 'not_found'             # the query didn't find the object
+
+DEFAULT_TTL = 24 * 3600
+DEFAULT_FAILED_TTL = 10 * 60
+
+
+class NegativeCache(object):
+    """Objects which couldn't be fetched, keyed by (database, four-part name)"""
+
+    def __init__(self, filename, ttl=DEFAULT_TTL, failed_ttl=DEFAULT_FAILED_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.failed_ttl = failed_ttl
+        self.entries = self._load()
+        self.changed = False
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        try:
+            f = open(self.filename, 'rb')
+            entries = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            logger.warning("Couldn't load negative cache %s: %s" % (self.filename, e))
+            return {}
+        return entries
+
+    def get_ttl(self, reason):
+        if reason == QUERY_FAILED:
+            return self.failed_ttl
+        return self.ttl
+
+    def is_expired(self, entry, now):
+        return now - entry['last'] >= self.get_ttl(entry['reason'])
+
+    def lookup(self, name, database):
+        """The entry of name if it couldn't be fetched from database within the ttl of its reason, else None"""
+        with self.lock:
+            entry = self.entries.get((database, name))
+            if entry is None:
+                return None
+            if self.is_expired(entry, time.time()):
+                del self.entries[(database, name)]
+                self.changed = True
+                return None
+            entry['count'] += 1
+            self.hits += 1
+            return entry
+
+    def record(self, name, database, reason, message):
+        if not self.get_ttl(reason):
+            return
+        with self.lock:
+            now = time.time()
+            entry = self.entries.setdefault((database, name), {'reason': reason, 'first': now, 'count': 0})
+            entry['reason'] = reason
+            entry['message'] = message
+            entry['last'] = now
+            entry['count'] += 1
+            self.changed = True
+
+    def forget(self, name):
+        """Ask Synergy for name again, on all databases"""
+        with self.lock:
+            for key in [key for key in self.entries.keys() if key[1] == name]:
+                del self.entries[key]
+                self.changed = True
+
+    def save(self):
+        """Merge the entries with the ones saved by other processes and store them"""
+        with self.lock:
+            if not self.changed:
+                return
+            entries = self._load()
+            for key, entry in self.entries.iteritems():
+                if key not in entries or entries[key]['last'] < entry['last']:
+                    entries[key] = entry
+            now = time.time()
+            self.entries = dict([(key, entry) for key, entry in entries.iteritems() if not self.is_expired(entry, now)])
+            f = open('%s.%d.tmp' % (self.filename, os.getpid()), 'wb')
+            cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename('%s.%d.tmp' % (self.filename, os.getpid()), self.filename)
+            self.changed = False
+
+    def get_metrics(self):
+        with self.lock:
+            reasons = {}
+            for entry in self.entries.values():
+                reasons[entry['reason']] = reasons.get(entry['reason'], 0) + 1
+            return {'entries': len(self.entries), 'hits': self.hits, 'reasons': reasons}
+
+    def get_report(self):
+        """Lines listing the objects which couldn't be fetched and haven't expired, by reason"""
+        now = time.time()
+        with self.lock:
+            entries = sorted([(key, entry) for key, entry in self.entries.iteritems() if not self.is_expired(entry, now)],
+                             key=lambda (key, entry): (entry['reason'], key))
+        lines = []
+        for (database, name), entry in entries:
+            lines.append("%-12s %6d %s %s %s: %s" % (entry['reason'], entry['count'],
+                                                     time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last'])),
+                                                     database, name, entry.get('message', '')))
+        return lines
+
+
+def create_negative_cache(ccm_cache_path, config):
+    """The negative cache of the ccm cache in ccm_cache_path, expiring as ccm_negative_ttl and ccm_negative_failed_ttl of config say"""
+    ttl = config.get('ccm_negative_ttl')
+    if ttl is None or ttl == '':
+        ttl = DEFAULT_TTL
+    failed_ttl = config.get('ccm_negative_failed_ttl')
+    if failed_ttl is None or failed_ttl == '':
+        failed_ttl = DEFAULT_FAILED_TTL
+    return NegativeCache(os.path.join(ccm_cache_path, NEGATIVE_CACHE_FILENAME), ttl, failed_ttl)
+
+
+def main():
+    from load_configuration import load_config_file
+    config = load_config_file()
+    # The same expiry as the runs which wrote it
+    cache = create_negative_cache(config['ccm_cache_path'], config)
+    lines = cache.get_report()
+    for line in lines:
+        print line
+    print "%d objects couldn't be fetched" % len(lines)
+
+if __name__ == '__main__':
+    main()
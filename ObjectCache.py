@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ObjectCache.py
+
+Keep the most recently used object meta data of the ccm cache in memory, so
+loading the same object again doesn't go to the disk.
+
+The objects are kept encoded by ObjectCodec: the callers change
+the objects they get (CCMHistory adds objects to tasks), so every get()
+returns a fresh copy, and the size of the encodings bounds the memory used.
+The least recently used objects are evicted once max_bytes is exceeded.
+Every process has its own cache, ccm_cache invalidates the objects it
+writes.
+"""
+
+import threading
+from collections import OrderedDict
+
+from ObjectCodec import encode, decode
+
+# Default bound of the cache, in bytes of encoded objects
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ObjectCache(object):
+    """LRU of encoded objects keyed by four-part name, bounded by their total size"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """A copy of the cached object name, or None"""
+        with self.lock:
+            data = self.entries.pop(name, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # Move it to the most recently used end
+            self.entries[name] = data
+            self.hits += 1
+        return decode(data)
+
+    def put(self, object):
+        if not self.max_bytes:
+            return
+        data = encode(object)
+        name = object.get_object_name()
+        with self.lock:
+            self._remove(name)
+            if len(data) > self.max_bytes:
+                return
+            self.entries[name] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1])
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self.lock:
+            if self._remove(name):
+                self.invalidations += 1
+
+    def _remove(self, name):
+        data = self.entries.pop(name, None)
+        if data is None:
+            return False
+        self.size -= len(data)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def get_metrics(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+_cache = ObjectCache()
+
+def get_object_cache():
+    """The object cache of this process"""
+    return _cache
+
+def set_object_cache(cache):
+    global _cache
+    _cache = cache
+
+def configure_object_cache(config):
+    """Size the cache from ccm_object_cache_size, in MB, 0 turns it off"""
+    size = config.get('ccm_object_cache_size')
+    if size is not None and size != '':
+        set_object_cache(ObjectCache(size * 1024 * 1024))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ObjectCodec.py
+
+Compact encoding of the Synergy objects in the ccm cache.
+
+An encoded object is MAGIC, the schema version, a flags byte and the
+marshal (version 2) dump of (class code, bit mask of the fields present,
+values of those fields, other attributes), zlib compressed when it is
+longer than COMPRESS_THRESHOLD. The fields of each class and their order are
+fixed by the schema version, so no attribute or class names are stored.
+Strings are interned before dumping: marshal writes a string repeated in
+the object (the separator, the instance, names in the members of a
+project) once and refers back to it, and loading interns them again, so
+objects share the strings in memory. Times are stored as integer seconds
+since the epoch. Lists are stored by marshal with their length up front.
+
+Data without MAGIC is a pickle, as written before this encoding, or for an
+object with attributes marshal can't store. decode() reads both.
+
+    ObjectCodec.py [count]      compare encode/decode times and sizes with cPickle
+"""
+
+import sys
+import time
+import zlib
+import marshal
+import cPickle
+from datetime import datetime, timedelta
+
+from SynergyObject import SynergyObject
+from FileObject import FileObject
+from DirectoryObject import DirectoryObject
+from TaskObject import TaskObject
+from ProjectObject import ProjectObject
+
+# Never the first byte of a pickle
+MAGIC = '\x00SY'
+SCHEMA_VERSION = 1
+
+_COMMON_FIELDS = ['separator', 'name', 'version', 'type', 'instance', 'author', 'status', 'created_time',
+                  'tasks', 'predecessors', 'successors', 'attributes', 'info_databases']
+
+# schema version -> class code -> (class, fields)
+SCHEMAS = {
+    1: {
+        0: (SynergyObject, _COMMON_FIELDS),
+        1: (FileObject, _COMMON_FIELDS + ['releases', 'content_hash']),
+        2: (DirectoryObject, _COMMON_FIELDS + ['releases', 'content_hash', 'new_objects', 'deleted_objects']),
+        3: (TaskObject, _COMMON_FIELDS + ['synopsis', 'description', 'release', 'objects', 'complete_time',
+                                          'released_projects', 'baselines']),
+        4: (ProjectObject, _COMMON_FIELDS + ['baseline_predecessor', 'baseline_successor', 'tasks_in_rp',
+                                             'baselines', 'released_time', 'members']),
+    },
+}
+
+# Fields holding a datetime or None
+TIME_FIELDS = set(['created_time', 'complete_time', 'released_time'])
+
+# Flags
+COMPRESSED = 1
+
+# Dumps longer than this are compressed, projects with their members mostly
+COMPRESS_THRESHOLD = 1024
+
+# Longer strings (logs, descriptions) are rarely repeated, they aren't interned
+MAX_INTERNED_LENGTH = 256
+
+EPOCH = datetime(1970, 1, 1)
+
+_class_codes = dict([(cls, code) for code, (cls, fields) in SCHEMAS[SCHEMA_VERSION].iteritems()])
+
+
+def encode(object):
+    """object as a string in the compact encoding, a pickle if marshal can't store it"""
+    code = _class_codes.get(type(object))
+    if code is None:
+        return cPickle.dumps(object, cPickle.HIGHEST_PROTOCOL)
+    fields = SCHEMAS[SCHEMA_VERSION][code][1]
+    attributes = dict(object.__dict__)
+    mask = 0
+    values = []
+    for i, field in enumerate(fields):
+        if field in attributes:
+            mask |= 1 << i
+            value = attributes.pop(field)
+            if field in TIME_FIELDS:
+                value = _encode_time(value)
+            values.append(_intern(value))
+    try:
+        dump = marshal.dumps((code, mask, values, _intern(attributes)), 2)
+    except ValueError:
+        # An attribute of a type marshal doesn't know
+        return cPickle.dumps(object, cPickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if len(dump) > COMPRESS_THRESHOLD:
+        flags |= COMPRESSED
+        dump = zlib.compress(dump, 6)
+    return MAGIC + chr(SCHEMA_VERSION) + chr(flags) + dump
+
+def decode(data):
+    """The object encoded in data by encode(), or pickled"""
+    if not data.startswith(MAGIC):
+        return cPickle.loads(data)
+    version = ord(data[len(MAGIC)])
+    if version not in SCHEMAS:
+        raise ObjectCodecException("Unknown schema version %d" % version)
+    dump = data[len(MAGIC) + 2:]
+    if ord(data[len(MAGIC) + 1]) & COMPRESSED:
+        dump = zlib.decompress(dump)
+    code, mask, values, attributes = marshal.loads(dump)
+    cls, present, times = _get_layout(version, code, mask)
+    attributes.update(zip(present, values))
+    for field in times:
+        attributes[field] = _decode_time(attributes[field])
+    object = cls.__new__(cls)
+    object.__dict__ = attributes
+    return object
+
+# (schema version, class code, mask) -> (class, fields present, time fields present)
+_layouts = {}
+
+def _get_layout(version, code, mask):
+    key = (version, code, mask)
+    layout = _layouts.get(key)
+    if layout is None:
+        cls, fields = SCHEMAS[version][code]
+        present = [field for i, field in enumerate(fields) if mask & (1 << i)]
+        layout = (cls, present, [field for field in present if field in TIME_FIELDS])
+        _layouts[key] = layout
+    return layout
+
+def is_encoded(data):
+    """If data is in the current compact encoding"""
+    return data.startswith(MAGIC) and ord(data[len(MAGIC)]) == SCHEMA_VERSION
+
+def _encode_time(value):
+    if value is None:
+        return None
+    delta = value - EPOCH
+    seconds = delta.days * 86400 + delta.seconds
+    if delta.microseconds:
+        return (seconds, delta.microseconds)
+    return seconds
+
+def _decode_time(value):
+    if value is None:
+        return None
+    if isinstance(value, tuple):
+        return EPOCH + timedelta(seconds=value[0], microseconds=value[1])
+    return EPOCH + timedelta(seconds=value)
+
+def _intern(value):
+    t = type(value)
+    if t is str:
+        if len(value) <= MAX_INTERNED_LENGTH:
+            return intern(value)
+        return value
+    if t is list:
+        return [_intern(v) for v in value]
+    if t is dict:
+        return dict([(_intern(k), _intern(v)) for k, v in value.iteritems()])
+    if t is tuple:
+        return tuple([_intern(v) for v in value])
+    return value
+
+
+class ObjectCodecException(Exception):
+    """User defined exception raised by ObjectCodec"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def create_sample_objects(count):
+    """count objects of each class, shaped like the ones in the cache"""
+    created = datetime(2011, 5, 4, 13, 37, 12)
+    status_log = '\n'.join(['%s: Status set to \'%s\' by user in role developer' % (created.strftime("%a %b %d %H:%M:%S %Y"), s)
+                            for s in ('working', 'integrate')])
+    objects = []
+    for i in range(count):
+        f = FileObject('file%d.c-%d:csrc:db#1' % (i, i % 7 + 1), '-', 'user%d' % (i % 50), 'integrate', created, ['db#%d:task:db#1' % (i % 900)])
+        f.predecessors = ['file%d.c-%d:csrc:db#1' % (i, i % 7)]
+        f.successors = ['file%d.c-%d:csrc:db#1' % (i, i % 7 + 2)]
+        f.set_attributes({'status_log': status_log, 'comment': 'Changed %d' % i})
+        f.info_databases = ['/db']
+        f.releases = ['rel/1.%d' % (i % 5)]
+        f.content_hash = '%040x' % i
+        objects.append(f)
+
+        t = TaskObject('db#%d:task:db#1' % i, '#', 'user%d' % (i % 50), 'completed', created, [])
+        t.synopsis = 'Task %d' % i
+        t.objects = ['file%d.c-%d:csrc:db#1' % (j, i % 7 + 1) for j in range(i, i + 5)]
+        t.set_attributes({'status_log': status_log})
+        t.complete_time = created
+        t.released_projects = ['project-1.%d:project:db#1' % (i % 5)]
+        objects.append(t)
+
+        if i % 10 == 0:
+            p = ProjectObject('project-1.%d:project:db#1' % i, '-', 'build', 'released', created, [])
+            p.members = dict([('file%d.c-%d:csrc:db#1' % (j, j % 7 + 1), ['project/src/dir%d/file%d.c' % (j % 20, j)]) for j in range(200)])
+            p.baselines = ['db#%d:task:db#1' % j for j in range(20)]
+            p.released_time = created
+            objects.append(p)
+    return objects
+
+def bench(count):
+    objects = create_sample_objects(count)
+    encoders = [('pickle 0', lambda o: cPickle.dumps(o), cPickle.loads),
+                ('pickle 2', lambda o: cPickle.dumps(o, cPickle.HIGHEST_PROTOCOL), cPickle.loads),
+                ('compact', encode, decode)]
+    print "%d objects" % len(objects)
+    print "%-10s %12s %12s %12s" % ('format', 'bytes', 'encode s', 'decode s')
+    for name, dumps, loads in encoders:
+        start = time.time()
+        data = [dumps(o) for o in objects]
+        encode_time = time.time() - start
+        start = time.time()
+        for d in data:
+            loads(d)
+        decode_time = time.time() - start
+        print "%-10s %12d %12.3f %12.3f" % (name, sum([len(d) for d in data]), encode_time, decode_time)
+
+def main():
+    count = 10000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    bench(count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ObjectLocks.py
+
+Advisory locks on the objects of a ccm cache, so several threads and
+processes can fill one cache without fetching the same object from
+Synergy twice.
+
+A process holds the lock of an object in the lock file of the cache, as a
+POSIX record lock on one byte at an offset derived from the sha1 of the
+four-part name: one file serves any number of objects, and the kernel
+drops the locks of a process that dies. Record locks belong to the process,
+so the threads of a process take an in-process lock of the object first.
+Locks of several objects are always taken in the order of their offsets,
+so two holders of overlapping sets can't deadlock.
+
+The caller checks the cache again once it holds the lock: whoever waited
+finds the object the holder fetched, which coalesces the concurrent
+requests for it into one fetch.
+"""
+
+import os
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Name of the lock file in the ccm cache
+LOCK_FILENAME = 'objects.lock'
+
+
+def get_offset(name):
+    """The byte of the lock file which locks the object name"""
+    return int(hashlib.sha1(name).hexdigest()[0:15], 16)
+
+
+class ObjectLocks(object):
+    """Locks on the objects of one ccm cache, across the threads and processes using it"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # name -> [in-process lock, threads using the entry, depth of the holding thread]
+        self.entries = {}
+        self.fd = None
+        self.pid = None
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+        self.coalesced = 0
+
+    def _get_fd(self):
+        """The lock file of this process, a forked process opens its own as record locks aren't inherited"""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+                self.pid = os.getpid()
+            return self.fd
+
+    @contextmanager
+    def locked(self, names):
+        """Hold the locks of all names for the with block"""
+        names = sorted(set(names), key=get_offset)
+        held = []
+        try:
+            for name in names:
+                self.acquire(name)
+                held.append(name)
+            yield
+        finally:
+            for name in reversed(held):
+                self.release(name)
+
+    def acquire(self, name):
+        with self.lock:
+            entry = self.entries.setdefault(name, [threading.RLock(), 0, 0])
+            entry[1] += 1
+            self.acquisitions += 1
+        start = time.time()
+        contended = not entry[0].acquire(False)
+        if contended:
+            entry[0].acquire()
+        # Only the thread holding the in-process lock touches the depth
+        if entry[2] == 0:
+            fd = self._get_fd()
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, get_offset(name))
+            except IOError:
+                contended = True
+                fcntl.lockf(fd, fcntl.LOCK_EX, 1, get_offset(name))
+        entry[2] += 1
+        if contended:
+            with self.lock:
+                self.contended += 1
+                self.wait_time += time.time() - start
+
+    def release(self, name):
+        entry = self.entries[name]
+        entry[2] -= 1
+        if entry[2] == 0:
+            fcntl.lockf(self._get_fd(), fcntl.LOCK_UN, 1, get_offset(name))
+        entry[0].release()
+        with self.lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.entries[name]
+
+    def add_coalesced(self, count):
+        """Count requests which found their object fetched by the holder of its lock"""
+        with self.lock:
+            self.coalesced += count
+
+    def get_metrics(self):
+        with self.lock:
+            return {'acquisitions': self.acquisitions, 'contended': self.contended,
+                    'wait_time': round(self.wait_time, 3), 'coalesced': self.coalesced}
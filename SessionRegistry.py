@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SessionRegistry.py
+
+Keep the ccm sessions started by one run for the next runs.
+
+The registry file lists every session with its CCM_ADDR, database, engine,
+the pid of the process using it and the time it was last used. A new
+SynergySession reattaches to a session of its database nobody is using,
+instead of waiting seconds for ccm start, and a session which is let go is
+handed back to the registry instead of being stopped. reap() stops the
+sessions nobody has used for a while.
+
+    SessionRegistry.py [max idle seconds]     stop the idle sessions
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import cPickle
+import logging as logger
+from subprocess import Popen, PIPE
+
+
+class SessionRegistry(object):
+    """Sessions shared between runs, stored in a pickle guarded by a lock file"""
+
+    def __init__(self, filename, max_idle=3600):
+        self.filename = filename
+        self.max_idle = max_idle
+
+    def _locked(self, update):
+        """Run update on the registry {addr: entry} under the lock and store the result"""
+        lock = open(self.filename + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            sessions = self._load()
+            result = update(sessions)
+            f = open(self.filename + '.tmp', 'wb')
+            cPickle.dump(sessions, f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(self.filename + '.tmp', self.filename)
+            return result
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        try:
+            f = open(self.filename, 'rb')
+            sessions = cPickle.load(f)
+            f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            logger.warning("Couldn't load session registry %s: %s" % (self.filename, e))
+            return {}
+        return sessions
+
+    def get_sessions(self):
+        return self._locked(lambda sessions: dict(sessions))
+
+    def checkout(self, database, engine, exclude=()):
+        """Claim a session of database and engine nobody uses, returns its CCM_ADDR or None"""
+        def claim(sessions):
+            candidates = [(entry['last_used'], addr) for addr, entry in sessions.iteritems()
+                          if entry['database'] == database and entry['engine'] == engine
+                          and addr not in exclude and not is_process_alive(entry['pid'])]
+            if not candidates:
+                return None
+            # The most recently used one is the most likely to be alive
+            addr = max(candidates)[1]
+            sessions[addr]['pid'] = os.getpid()
+            return addr
+        return self._locked(claim)
+
+    def register(self, addr, database, engine, command_name):
+        """Add a session started by this process"""
+        def add(sessions):
+            sessions[addr] = {'database': database,
+                              'engine': engine,
+                              'command_name': command_name,
+                              'pid': os.getpid(),
+                              'started': time.time(),
+                              'last_used': time.time()}
+        self._locked(add)
+
+    def claim(self, addr, pid=None):
+        """Mark a session as used by pid, this process by default"""
+        def take(sessions):
+            if addr in sessions:
+                sessions[addr]['pid'] = pid or os.getpid()
+        self._locked(take)
+
+    def release(self, addr):
+        """Hand a session back for the next user"""
+        def free(sessions):
+            if addr in sessions:
+                sessions[addr]['pid'] = None
+                sessions[addr]['last_used'] = time.time()
+        self._locked(free)
+
+    def remove(self, addr):
+        self._locked(lambda sessions: sessions.pop(addr, None))
+
+    def reap(self, max_idle=None):
+        """Stop the sessions nobody has used for max_idle seconds, returns their CCM_ADDRs"""
+        if max_idle is None:
+            max_idle = self.max_idle
+        def take_idle(sessions):
+            now = time.time()
+            idle = [(addr, entry) for addr, entry in sessions.iteritems()
+                    if not is_process_alive(entry['pid']) and now - entry['last_used'] >= max_idle]
+            for addr, entry in idle:
+                del sessions[addr]
+            return idle
+        idle = self._locked(take_idle)
+        for addr, entry in idle:
+            logger.info("Stopping session %s of %s, idle for %d s" % (addr, entry['database'], time.time() - entry['last_used']))
+            stop_session(addr, entry['command_name'])
+        return [addr for addr, entry in idle]
+
+
+def is_process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def stop_session(addr, command_name='ccm'):
+    env = os.environ.copy()
+    env['CCM_ADDR'] = addr
+    try:
+        stdout, stderr = Popen([command_name, 'stop'], stdout=PIPE, stderr=PIPE, env=env).communicate()
+    except OSError, e:
+        stderr = str(e)
+    if stderr:
+        logger.warning("Couldn't stop session %s: %s" % (addr, stderr))
+
+
+_registry = None
+
+def get_session_registry():
+    """The session registry of this process, None when sessions aren't kept between runs"""
+    return _registry
+
+def set_session_registry(registry):
+    global _registry
+    _registry = registry
+
+def configure_session_registry(config):
+    """Set up the registry from the ccm_session_registry* keys of the configuration and reap it"""
+    if config.get('ccm_session_registry'):
+        registry = SessionRegistry(config['ccm_session_registry'], config.get('ccm_session_max_idle') or 3600)
+        set_session_registry(registry)
+        registry.reap()
+
+
+def main():
+    from load_configuration import load_config_file
+    config = load_config_file()
+    if not config.get('ccm_session_registry'):
+        print "No ccm_session_registry configured"
+        return
+    registry = SessionRegistry(config['ccm_session_registry'])
+    max_idle = config.get('ccm_session_max_idle') or 3600
+    if len(sys.argv) > 1:
+        max_idle = int(sys.argv[1])
+    for addr in registry.reap(max_idle):
+        print "Stopped %s" % addr
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SynergyDatabases.py
+
+A group of sessions, one on each of several federated Synergy databases,
+running the same work on all of them at once.
+
+Every database is served by its own thread and session, ccm does the work
+in its own processes, so the databases are queried concurrently.
+"""
+
+import threading
+import logging as logger
+
+from SynergySession import SynergySession
+
+
+class SynergyDatabases(object):
+    """One SynergySession per database, map() runs a function on all of them concurrently"""
+
+    def __init__(self, databases, engine=None, command_name='ccm', offline=False, channel=None):
+        self.databases = list(databases)
+        self.sessions = {}
+        errors = {}
+        # ccm start takes seconds, start all sessions at once
+        self.map_sessions(self._start_session, [(database, engine, command_name, offline, channel) for database in self.databases], errors)
+        if errors:
+            raise SynergyDatabasesException("Couldn't start sessions on %s" % ', '.join(sorted(errors.keys())))
+
+    def _start_session(self, database, engine, command_name, offline, channel):
+        self.sessions[database] = SynergySession(database, engine, command_name, offline=offline, channel=channel)
+
+    def map_sessions(self, func, arguments, errors):
+        """Run func(*args) for every args in arguments, each on its own thread
+
+        Returns the results in the order of arguments, with None for the calls
+        which raised. The exceptions go into errors, keyed by the first argument"""
+        results = [None] * len(arguments)
+        def run(i, args):
+            try:
+                results[i] = func(*args)
+            except Exception, e:
+                logger.warning("%s failed on %s: %s" % (func.__name__, args[0], e))
+                errors[args[0]] = e
+        threads = [threading.Thread(target=run, args=(i, args)) for i, args in enumerate(arguments)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def map(self, func, *args):
+        """Run func(ccm, *args) on the session of every database at once
+
+        Returns {database name: result}, databases where func raised are left out"""
+        errors = {}
+        sessions = [self.sessions[database] for database in self.databases]
+        results = self.map_sessions(func, [(ccm,) + args for ccm in sessions], errors)
+        return dict([(ccm.get_database_name(), result) for ccm, result in zip(sessions, results) if ccm not in errors])
+
+    def get_database_names(self):
+        return [self.sessions[database].get_database_name() for database in self.databases]
+
+    def __iter__(self):
+        return iter([self.sessions[database] for database in self.databases])
+
+
+class SynergyDatabasesException(Exception):
+    """User defined exception raised by SynergyDatabases"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
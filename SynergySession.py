@@ -23,14 +23,26 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 import os
 import re
 import time
-import random
+import tempfile
 import logging as logger
 from subprocess import Popen, PIPE
+from CommandChannel import CommandChannel, CommandChannelException
+from EngineLimiter import get_engine_limiter
+from CommandMemo import get_command_memo
+from Cassette import get_cassette, CassetteException
+from CommandStats import get_command_stats, get_command_kind
+from SessionRegistry import get_session_registry
+
+ITEM_SEPARATOR = '|ITEM_SEPARATOR|'
+HIST_SEPARATOR = '*****************************************************************************'
+
+# Bytes read from a streaming command at a time
+STREAM_CHUNK_SIZE = 65536
 
 class SynergySession(object):
     """This class is a wrapper around the Synergy command line client"""
 
-    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', ccm_addr=None, offline=False):
+    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', ccm_addr=None, offline=False, channel=None):
         self.command_name = command_name
         self.database = database
         self.engine = engine
@@ -46,6 +58,11 @@ class SynergySession(object):
         self.errors = []
         self.offline = offline
 
+        # Optional helper process all commands are streamed through, see CommandChannel
+        self.channel_command = channel
+        self.channel = None
+        self.channel_pid = None
+
         # Open the session
         args = [self.command_name]
         args.append('start')
@@ -64,9 +81,16 @@ class SynergySession(object):
         self.environment['CCM_UILOG'] = ccm_ui_path
         self.environment['CCM_ENGLOG'] = ccm_eng_path
 
+        # Set when the session is listed in the session registry, see SessionRegistry
+        self.registered = False
+
         #Check if an existing session should be used
         if not ccm_addr:
-            if not self.offline:
+            cassette = get_cassette()
+            if self.offline or (cassette and cassette.is_replaying()):
+                # fake it
+                self.environment['CCM_ADDR'] = "12345:0.0.0.0"
+            elif not self._reattach():
                 # Open the session
                 p = Popen(args, stdout=PIPE, stderr=PIPE, env=self.environment)
                 # Store the session data
@@ -77,36 +101,90 @@ class SynergySession(object):
 
                 # Set the environment variable for the Synergy session
                 self.environment['CCM_ADDR'] = stdout
-            else:
-                # fake it
-                self.environment['CCM_ADDR'] = "12345:0.0.0.0"
+                registry = get_session_registry()
+                if registry is not None:
+                    registry.register(self.getCCM_ADDR(), self.database, self.engine, self.command_name)
+                    self.registered = True
         else:
             self.environment['CCM_ADDR'] = ccm_addr
 
         # Get the delimiter and store it
         self.delimiter = self.delim()
 
+    def _reattach(self):
+        """Take over a session of this database left by an earlier run, if the registry has a live one"""
+        registry = get_session_registry()
+        if registry is None:
+            return False
+        tried = []
+        while True:
+            addr = registry.checkout(self.database, self.engine, tried)
+            if addr is None:
+                return False
+            self.environment['CCM_ADDR'] = addr
+            if self._probe():
+                logger.info("Reattached to session %s" % addr)
+                self.registered = True
+                return True
+            logger.info("Session %s is gone, removing it from the registry" % addr)
+            registry.remove(addr)
+            tried.append(addr)
+
+    def _probe(self):
+        """Check the session is alive with a cheap command, straight to ccm"""
+        try:
+            p = Popen([self.command_name, 'delim'], stdout=PIPE, stderr=PIPE, env=self.environment)
+            stdout, stderr = p.communicate()
+        except OSError:
+            return False
+        return p.returncode == 0 and not stderr
+
+    def is_registered(self):
+        return self.registered and get_session_registry() is not None
+
+    def release(self):
+        """Hand the session back to the session registry for the next run, instead of stopping it"""
+        get_session_registry().release(self.getCCM_ADDR())
+        self._close_channel()
+
     def setSessionID(self, sessionID):
         self.sessionID = sessionID
 
     def getSessionID(self):
         return self.sessionID
 
+    def get_engine_key(self):
+        """Key of the engine this session runs on, shared by all its sessions"""
+        if self.engine:
+            return self.engine
+        return self.database
+
     def getCCM_ADDR(self):
         return self.environment['CCM_ADDR'].strip()
 
     def get_database_name(self):
         splitted = os.path.split(self.database)
         if splitted[-1] == '':
-            return os.path.split(splitted)[1]
+            return os.path.split(splitted[0])[1]
         return splitted[-1]
 
     def __del__(self):
         # Close the session
         if not self.keep_session_alive:
-            self.stop()
-            if not self.offline:
-                print "Stopping %s" % self.getCCM_ADDR()
+            if self.is_registered():
+                self.release()
+            else:
+                self.stop()
+                if not self.offline:
+                    print "Stopping %s" % self.getCCM_ADDR()
+        self._close_channel()
+
+    def __getstate__(self):
+        # The channel process belongs to the process that started it, a copy reopens its own
+        state = self.__dict__.copy()
+        state['channel'] = None
+        state['channel_pid'] = None
+        return state
 
     def _reset_status(self):
         """Reset the status of the object"""
@@ -121,33 +199,91 @@ class SynergySession(object):
             command.insert(0, self.command_name)
 
         if not self.offline:
+            stats = get_command_stats()
+            kind = get_command_kind(command[1:])
+            memo = get_command_memo()
+            stdout = memo.lookup(self.database, command[1:])
+            if stdout is not None:
+                stats.record_memo_hit(kind)
+                return stdout
+
+            start = time.time()
+            limiter = get_engine_limiter(self.get_engine_key())
             # retry all commands 3 times to patch over ccm concurrency issues
             for retrycount in range(3):
-                # stagger parallel commands to patch over ccm concurrency issues
-                if (self.sessionID >= 0):
-                    time.sleep(0.2 * random.random())
-
-                if (retrycount > 0): # more sleep on retry operations
-                    time.sleep(0.2 * random.random())
-
-                p = Popen(command, stdout=PIPE, stderr=PIPE, env=self.environment)
+                # the limiter only slows down when the engine reports contention
+                limiter.acquire()
 
                 # Store the result as a single string. It will be splitted later
-                stdout, stderr = p.communicate()
+                stdout, stderr = self._execute(command)
 
                 if not stderr:
+                    limiter.success()
                     break
+                if retrycount < 2:
+                    limiter.failure(stderr, retrycount)
 
+            stats.record(kind, time.time() - start, len(stdout), retrycount, error=bool(stderr))
             if stderr:
                 raise SynergyException('Error while running the Synergy command: %s \nError message: %s' % (command, stderr))
             else:
                 # Log command
                 logger.info('Synergy offline mode, cmd: %s' %command )
-                pass
+                memo.store(self.database, command[1:], stdout)
 
             return stdout
         return ""
 
+    def _execute(self, command):
+        """Execute a single command, or replay it from the cassette"""
+        cassette = get_cassette()
+        if cassette and cassette.is_replaying():
+            try:
+                return cassette.replay(self.get_database_name(), command[1:])
+            except CassetteException, e:
+                raise SynergyException(e.value)
+
+        start = time.time()
+        stdout, stderr = self._execute_command(command)
+        if cassette and cassette.is_recording():
+            cassette.record(self.get_database_name(), command[1:], stdout, stderr, time.time() - start)
+        return stdout, stderr
+
+    def _execute_command(self, command):
+        """Execute a single command, through the command channel if one is configured"""
+        channel = self._get_channel()
+        if channel:
+            try:
+                returncode, stdout, stderr = channel.execute(command[1:])
+                return stdout, stderr
+            except CommandChannelException, e:
+                logger.warning('%s, falling back to one process per command' % e.value)
+                self._close_channel()
+                self.channel_command = None
+
+        p = Popen(command, stdout=PIPE, stderr=PIPE, env=self.environment)
+        return p.communicate()
+
+    def _get_channel(self):
+        """Get the command channel of this process, starting it if needed"""
+        if not self.channel_command:
+            return None
+        if self.channel is None or self.channel_pid != os.getpid():
+            try:
+                self.channel = CommandChannel(self.channel_command, self.environment)
+                self.channel_pid = os.getpid()
+            except OSError, e:
+                logger.warning("Couldn't start command channel %s: %s, falling back to one process per command" % (self.channel_command, e))
+                self.channel = None
+                self.channel_command = None
+        return self.channel
+
+    def _close_channel(self):
+        if self.channel is not None and self.channel_pid == os.getpid():
+            self.channel.close()
+        self.channel = None
+        self.channel_pid = None
+
     def delim(self):
         """Returns the delimiter defined in the Synergy DB"""
         self._reset_status()
@@ -158,8 +294,12 @@ class SynergySession(object):
 
     def stop(self):
         """Stops the current Synergy session"""
-        if 'CCM_ADDR' in self.environment:
+        cassette = get_cassette()
+        if 'CCM_ADDR' in self.environment and not (cassette and cassette.is_replaying()):
             self._run(['stop'])
+            if self.is_registered():
+                get_session_registry().remove(self.getCCM_ADDR())
+        self._close_channel()
 
     def query(self, query_string):
         """Set a query that will be executed"""
@@ -170,6 +310,18 @@ class SynergySession(object):
             self.status['format'] = ['%objectname']
         return self
 
+    def query_many(self, query_strings, format, batch_size=100):
+        """Run many queries as a few 'or' combined queries and return all result rows
+
+        format is a list of format fields, as given to format()"""
+        result = []
+        for i in range(0, len(query_strings), batch_size):
+            batch = query_strings[i:i + batch_size]
+            self.query(' or '.join(['(%s)' % q for q in batch]))
+            self.status['format'] = list(format)
+            result.extend(self.run())
+        return result
+
     def cat(self, object_name):
         """Cat an object"""
         self.command = 'cat'
@@ -230,9 +382,12 @@ class SynergySession(object):
         return self
 
     def hist(self, obj):
-        """history command"""
+        """history command, obj can be one object or a list of objects"""
         self.command = 'hist'
-        self.status['arguments'] = [obj]
+        if isinstance(obj, str):
+            self.status['arguments'] = [obj]
+        else:
+            self.status['arguments'] = list(obj)
         self.status['options'] = []
         self.status['formattable'] = True
         if 'format' not in self.status:
@@ -281,12 +436,8 @@ class SynergySession(object):
 
         return self
 
-    def run(self):
-        """
-        Run the Synergy command.
-
-        At this point the command must be already set by i.e. query()
-        """
+    def _build_command(self):
+        """Build the command line for the command set by i.e. query()"""
         if not self.status:
             self.errors.append('before run() the status of the command must be already set')
 
@@ -315,44 +466,52 @@ class SynergySession(object):
                 command.append(element)
 
         command.extend(self.status['arguments'])
+        return command
+
+    def _parse_item(self, item, format, hist):
+        """Parse one item of the output of a formatted command into a dictionary"""
+        splitted_item = item.split('|SEPARATOR|')
+        if len(splitted_item) != len(format):
+            raise SynergyException("the length of status['format'] and the splitted result is not the same")
+        line = {}
+        for k, v in zip(format, splitted_item):
+            line[k[1:]] = v.strip()
+        if hist:
+            # History command is special ;)
+            p = re.compile("(?s)(.*?)Predecessors:\s*(.*)Successors:\s*(.*?)$")
+            m = p.match(splitted_item[len(splitted_item) - 1])
+            if m:
+                line[format[-1][1:]] = m.group(1).strip()
+                line['predecessors'] = m.group(2).split()
+                line['successors'] = m.group(3).split()
+            else:
+                line['predecessors'] = []
+                line['successors'] = []
+        return line
+
+    def _parse_output(self, result, format, hist):
+        """Parse the complete output of a formatted command into a list of dictionaries"""
+        if not result:
+            return []
+        if hist:
+            items = result.split(HIST_SEPARATOR)[:-1]
+        else:
+            items = result.split(ITEM_SEPARATOR)[:-1]
+        return [self._parse_item(item, format, hist) for item in items]
+
+    def run(self):
+        """
+        Run the Synergy command.
+
+        At this point the command must be already set by i.e. query()
+        """
+        command = self._build_command()
 
         result = self._run(command)
         # Parse the result and return it
         if 'formattable' in self.status and self.status['formattable']:
-            if not result:
-                # Clean up
-                self._reset_status()
-                return []
-
-            final_result = []
-            items = []
-            if 'hist' in command:
-                items = result.split('*****************************************************************************')[
-                        :-1]
-            else:
-                items = result.split('|ITEM_SEPARATOR|')[:-1]
-
-            for item in items:
-                splitted_item = item.split('|SEPARATOR|')
-                if len(splitted_item) != len(self.status['format']):
-                    raise SynergyException("the length of status['format'] and the splitted result is not the same")
-                line = {}
-                for k, v in zip(self.status['format'], splitted_item):
-                    line[k[1:]] = v.strip()
-                if 'hist' in command:
-                    # History command is special ;)
-                    p = re.compile("(?s)(.*?)Predecessors:\s*(.*)Successors:\s*(.*?)$")
-                    m = p.match(splitted_item[len(splitted_item) - 1])
-                    if m:
-                        line[self.status['format'][-1]] = m.group(1).split()
-                        line['predecessors'] = m.group(2).split()
-                        line['successors'] = m.group(3).split()
-                    else:
-                        line['predecessors'] = []
-                        line['successors'] = []
-
-                final_result.append(line)
-                # Clean up
+            final_result = self._parse_output(result, self.status['format'], 'hist' in command)
+            # Clean up
             self._reset_status()
             return final_result
         else:
@@ -360,6 +519,103 @@ class SynergySession(object):
             self._reset_status()
             return result
 
+    def run_iter(self):
+        """
+        Run the Synergy command and return an iterator over the result, the
+        items are parsed and yielded while the command is still running.
+
+        Only formattable commands can be run this way.
+        """
+        command = self._build_command()
+        if not ('formattable' in self.status and self.status['formattable']):
+            raise SynergyException("run_iter() needs a formattable command, use run()")
+        format = self.status['format']
+        hist = 'hist' in command
+        # Clean up, the command is fully described by command and format now
+        self._reset_status()
+
+        if hist:
+            items = self._run_stream(command, HIST_SEPARATOR)
+        else:
+            items = self._run_stream(command, ITEM_SEPARATOR)
+        return (self._parse_item(item, format, hist) for item in items)
+
+    def _run_stream(self, command, separator):
+        """Execute a Synergy command and yield its output split by separator as it arrives
+
+        The command is retried like in _run as long as nothing has been
+        yielded, an error after that raises, as the output is incomplete"""
+        if self.offline:
+            return
+        if self._get_channel() or get_command_memo().is_cacheable(command[1:]) or get_cassette():
+            # The channel, the memo and the cassette deal in complete responses
+            for item in self._run(command).split(separator)[:-1]:
+                yield item
+            return
+
+        start = time.time()
+        # stdout_bytes and stderr of the last try
+        result = {'stdout_bytes': 0, 'stderr': ''}
+        error = True
+        limiter = get_engine_limiter(self.get_engine_key())
+        try:
+            # retry all commands 3 times to patch over ccm concurrency issues
+            for retrycount in range(3):
+                limiter.acquire()
+                yielded = False
+                items = self._stream_once(command, separator, result)
+                try:
+                    for item in items:
+                        yielded = True
+                        yield item
+                finally:
+                    items.close()
+                stderr = result['stderr']
+                if not stderr:
+                    limiter.success()
+                    error = False
+                    return
+                if yielded or retrycount == 2:
+                    if limiter.is_contention(stderr):
+                        limiter.failure(stderr, retrycount)
+                    raise SynergyException('Error while running the Synergy command: %s \nError message: %s' % (command, stderr))
+                limiter.failure(stderr, retrycount)
+        except GeneratorExit:
+            # The caller stopped iterating before the end of the output
+            error = False
+            raise
+        finally:
+            get_command_stats().record(get_command_kind(command[1:]), time.time() - start, result['stdout_bytes'], retrycount, error=error)
+
+    def _stream_once(self, command, separator, result):
+        """Run command once and yield its output split by separator, its stderr is left in result"""
+        result['stdout_bytes'] = 0
+        result['stderr'] = ''
+        # stderr goes to a file, so the pipe of stdout is the only one to keep drained
+        stderr_file = tempfile.TemporaryFile()
+        p = Popen(command, stdout=PIPE, stderr=stderr_file, env=self.environment)
+        try:
+            rest = ''
+            while True:
+                chunk = os.read(p.stdout.fileno(), STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                result['stdout_bytes'] += len(chunk)
+                items = (rest + chunk).split(separator)
+                rest = items.pop()
+                for item in items:
+                    yield item
+            p.wait()
+            stderr_file.seek(0)
+            result['stderr'] = stderr_file.read()
+        finally:
+            if p.poll() is None:
+                # Stopped before the end of the output
+                p.kill()
+                p.wait()
+            p.stdout.close()
+            stderr_file.close()
+
 
 class SynergyException(Exception):
     """User defined exception raised by SynergySession"""
@@ -27,17 +27,40 @@ import re
 import random
 from datetime import datetime, timedelta
 from subprocess import Popen, PIPE
-from SynergySession import SynergySession
+from SynergySession import SynergySession, SynergyException
+from SessionRegistry import get_session_registry
 import time
-from multiprocessing import Pool, Process, Queue
+import threading
+import logging as logger
+from Queue import Queue as ThreadQueue
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import Pool, Process, Queue, Manager
+from CommandFuture import CommandFuture
 
 sys.stdout =  os.fdopen(sys.stdout.fileno(), 'w', 0);
 sys.stderr =  os.fdopen(sys.stderr.fileno(), 'w', 0);
 
 class SynergySessions(object):
-    """This class is a wrapper around a pool of cm synergy sessions"""
+    """This class is a wrapper around a pool of cm synergy sessions
 
-    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', nr_sessions=2, offline=False):
+    Sessions are checked out with lease(). The state of the pool is kept in
+    this process, behind a threading.Condition; a pool created with
+    shared=True keeps it in a multiprocessing.Manager instead, so it can be
+    passed to other processes, at the cost of a round trip to the manager
+    for every access. The pool starts nr_sessions sessions and grows up to
+    max_sessions when all sessions are leased. Sessions idle for more than
+    idle_timeout seconds are stopped until min_sessions are left, and sessions
+    idle for more than probe_interval seconds, or whose lease ended with an
+    exception, are probed and replaced if their engine has died.
+
+    submit() and map() run functions on threads of this process, each thread
+    leasing one session for as long as it finds work. Every thread has its
+    own queue of tasks and steals from the others when its own runs dry.
+    At most max_queued tasks wait at a time, submit() blocks beyond that."""
+
+    def __init__(self, database, engine=None, command_name='ccm', ccm_ui_path='/dev/null', ccm_eng_path='/dev/null', nr_sessions=2, offline=False, channel=None,
+                 max_sessions=None, min_sessions=1, lease_timeout=None, idle_timeout=300, probe_interval=60, max_queued=None, worker_idle=5, shared=False):
         self.database = database
         self.command_name = command_name
         self.ccm_ui_path = ccm_ui_path
@@ -45,19 +68,66 @@ class SynergySessions(object):
         self.engine = engine
         self.nr_sessions = nr_sessions
         self.max_session_index = nr_sessions-1
+        self.max_sessions = max(max_sessions or nr_sessions, nr_sessions)
+        self.min_sessions = min(min_sessions, nr_sessions)
+        self.lease_timeout = lease_timeout
+        self.idle_timeout = idle_timeout
+        self.probe_interval = probe_interval
         self.sessionArray = {}
         self.offline = offline
+        self.channel = channel
+
+        # key -> {'addr', 'free', 'last_used'} of every running session
+        self.shared = shared
+        if shared:
+            # Shared by all processes the pool is passed to through a manager
+            self.manager = Manager()
+            self.sessions = self.manager.dict()
+            self.condition = self.manager.Condition()
+            self.starting = self.manager.Value('i', 0)
+            self.serial = self.manager.Value('i', 0)
+        else:
+            self.manager = None
+            self.sessions = {}
+            self.condition = threading.Condition()
+            self.starting = LocalValue(0)
+            self.serial = LocalValue(0)
+        self.owner = os.getpid()
+        # key -> SynergySession of the sessions used by this process
+        self.local_sessions = {}
+        self.local_pid = os.getpid()
+        # The threads of submit() and map() in this process
+        self.max_queued = max_queued or 4 * self.max_sessions
+        self.worker_idle = worker_idle
+        self._reset_workers()
+
         """populate and array with synergy sessions"""
-        create_sessions_pool(self.nr_sessions, self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, self.offline, self)
+        create_sessions_pool(self.nr_sessions, self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, self.offline, self, self.channel)
 
         for k, v in self.sessionArray.iteritems():
             print "session %d: %s" %(k, v.getCCM_ADDR())
-            v.keep_session_alive = False
+            v.keep_session_alive = True
+            self._add_session(v, free=True)
 
     def put_session(self, res):
         idx, ccm = res
         self.sessionArray[idx] = ccm
 
+    def __getstate__(self):
+        if not self.shared:
+            raise SynergySessionsException("Create the pool with shared=True to pass it to other processes")
+        # The manager belongs to the process that started the pool, the shared state goes through its proxies
+        state = self.__dict__.copy()
+        del state['manager']
+        state['sessionArray'] = {}
+        state['local_sessions'] = {}
+        for k in ('task_condition', 'task_queues', 'workers'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_workers()
 
     def __getitem__(self, index):
         if ((index > self.max_session_index) or (index < 0)):
@@ -67,15 +137,354 @@ class SynergySessions(object):
 
     def __str__(self):
         retstring = ''
-        for i in range (self.nr_sessions):
-            retstring = retstring + "[" + str(i) + "] " + self.sessionArray[i].getCCM_ADDR() + "\n"
+        for entry in self.sessions.values():
+            retstring = retstring + "[" + ("free" if entry['free'] else "leased") + "] " + entry['addr'] + "\n"
         return retstring
 
-def create_sessions_pool(nr_sessions, database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, session_cls):
+    @contextmanager
+    def lease(self, timeout=None):
+        """Check out a session for the duration of a with block
+
+        A session whose lease ends with an exception is probed before it is
+        given to the next caller"""
+        ccm = self.checkout(timeout)
+        failed = True
+        try:
+            yield ccm
+            failed = False
+        finally:
+            self.checkin(ccm, probe=failed)
+
+    def checkout(self, timeout=None):
+        """Get a free session, starting one if all are leased and the pool may grow
+
+        Waits up to timeout seconds, or lease_timeout when not given, for a
+        session to be checked in, forever if both are None"""
+        if timeout is None:
+            timeout = self.lease_timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            key = None
+            self.condition.acquire()
+            try:
+                while True:
+                    key = self._pick_free()
+                    if key is not None:
+                        entry = self.sessions[key]
+                        entry['free'] = False
+                        self.sessions[key] = entry
+                        break
+                    if len(self.sessions) + self.starting.value < self.max_sessions:
+                        # Grow, the session is started outside the lock
+                        self.starting.value += 1
+                        break
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise SynergySessionsException("No free session within %s s" % timeout)
+                    self.condition.wait(remaining)
+            finally:
+                self.condition.release()
+
+            if key is None:
+                try:
+                    ccm = self._start_session()
+                finally:
+                    self.condition.acquire()
+                    self.starting.value -= 1
+                    self.condition.notify_all()
+                    self.condition.release()
+                return ccm
+
+            ccm = self._get_session(key, entry['addr'])
+            if time.time() - entry['last_used'] < self.probe_interval or self.is_alive(ccm):
+                return ccm
+            logger.warning("Session %s died, replacing it" % entry['addr'])
+            self._discard(key)
+
+    def checkin(self, ccm, probe=False):
+        """Give a leased session back, a session failing the probe is stopped instead"""
+        key = ccm.pool_key
+        if probe and not self.is_alive(ccm):
+            logger.warning("Session %s died, dropping it" % ccm.getCCM_ADDR())
+            self._discard(key)
+            return
+        self.condition.acquire()
+        try:
+            if key in self.sessions:
+                entry = self.sessions[key]
+                entry['free'] = True
+                entry['last_used'] = time.time()
+                self.sessions[key] = entry
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        self._reap_idle()
+
+    def is_alive(self, ccm):
+        """Probe the engine of ccm with a command answered by the engine itself"""
+        if self.offline:
+            return True
+        try:
+            stdout, stderr = ccm._execute([ccm.command_name, 'delim'])
+        except (OSError, SynergyException), e:
+            logger.warning("Probing session %s failed: %s" % (ccm.getCCM_ADDR(), e))
+            return False
+        return not stderr
+
+    def close(self):
+        """Stop all sessions of the pool, or hand them back to the session registry"""
+        self.shutdown()
+        self.condition.acquire()
+        try:
+            keys = self.sessions.keys()
+            entries = [(k, self.sessions.pop(k)) for k in keys]
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        for key, entry in entries:
+            self._stop_session(key, entry['addr'], keep=True)
+
+    def submit(self, func, *args, **options):
+        """Run func(ccm, *args) on a thread with a session of the pool, returns a CommandFuture
+
+        The future is put on the queue given as done_queue when func has returned"""
+        future = CommandFuture((func.__name__,) + args, options.get('done_queue'))
+        self.task_condition.acquire()
+        try:
+            while self._queued() >= self.max_queued:
+                self.task_condition.wait()
+            if len(self.workers) < self.max_sessions and self._queued() >= self.idle_workers:
+                self._start_worker()
+            # The shortest queue gets the task, the others will steal it if it has to wait
+            queue = min(self.task_queues.values(), key=len)
+            queue.append((future, func, args))
+            self.task_condition.notify_all()
+        finally:
+            self.task_condition.release()
+        return future
+
+    def map(self, func, items, ordered=False):
+        """Yield func(ccm, item) for all items, run on the threads of submit()
+
+        The results come as they are done, or in the order of items when
+        ordered is set. Items are taken from the iterable as the threads
+        catch up, so it can be a generator of any length."""
+        done_queue = ThreadQueue()
+        pending = deque()
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.max_queued:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append(self.submit(func, item, done_queue=done_queue))
+            if not pending:
+                return
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = done_queue.get()
+                pending.remove(future)
+            yield future.result()
+
+    def shutdown(self):
+        """Stop the threads of submit() once their queues are empty"""
+        self.task_condition.acquire()
+        try:
+            self.stopping = True
+            self.task_condition.notify_all()
+            workers = self.workers.values()
+        finally:
+            self.task_condition.release()
+        for worker in workers:
+            worker.join()
+        self.stopping = False
+
+    def _reset_workers(self):
+        self.task_condition = threading.Condition()
+        # worker index -> deque of (future, func, args)
+        self.task_queues = {}
+        # worker index -> Thread
+        self.workers = {}
+        self.worker_index = 0
+        self.idle_workers = 0
+        self.stopping = False
+
+    def _queued(self):
+        return sum([len(q) for q in self.task_queues.values()])
+
+    def _start_worker(self):
+        self.worker_index += 1
+        self.task_queues[self.worker_index] = deque()
+        worker = threading.Thread(target=self._work, args=(self.worker_index,))
+        worker.daemon = True
+        self.workers[self.worker_index] = worker
+        worker.start()
+
+    def _next_task(self, index):
+        """The next task of worker index, its own first, else one stolen from the longest queue
+
+        Returns None when the worker has been idle for worker_idle seconds"""
+        self.task_condition.acquire()
+        try:
+            idle_since = time.time()
+            while True:
+                task = None
+                if self.task_queues[index]:
+                    task = self.task_queues[index].popleft()
+                else:
+                    longest = max(self.task_queues.values(), key=len)
+                    if longest:
+                        # Steal from the other end, the owner works from the front
+                        task = longest.pop()
+                if task is not None:
+                    self.task_condition.notify_all()
+                    return task
+                remaining = self.worker_idle - (time.time() - idle_since)
+                if self.stopping or remaining <= 0:
+                    # Nothing left anywhere, which the lock guarantees to stay true until we are gone
+                    del self.task_queues[index]
+                    del self.workers[index]
+                    return None
+                self.idle_workers += 1
+                self.task_condition.wait(remaining)
+                self.idle_workers -= 1
+        finally:
+            self.task_condition.release()
+
+    def _work(self, index):
+        """Run tasks with one leased session until there are none left for a while"""
+        ccm = None
+        try:
+            while True:
+                task = self._next_task(index)
+                if task is None:
+                    break
+                future, func, args = task
+                try:
+                    if ccm is None:
+                        ccm = self.checkout()
+                    future.set_result(func(ccm, *args))
+                except Exception, e:
+                    future.set_exception(e)
+                    if ccm is not None and isinstance(e, SynergyException) and not self.is_alive(ccm):
+                        self._discard(ccm.pool_key)
+                        ccm = None
+        finally:
+            if ccm is not None:
+                self.checkin(ccm)
+
+    def _pick_free(self):
+        """The key of the most recently used free session, so the others age out"""
+        free = [(entry['last_used'], key) for key, entry in self.sessions.items() if entry['free']]
+        if not free:
+            return None
+        return max(free)[1]
+
+    def _add_session(self, ccm, free):
+        self.condition.acquire()
+        try:
+            self.serial.value += 1
+            key = self.serial.value
+            self.sessions[key] = {'addr': ccm.getCCM_ADDR(), 'free': free, 'last_used': time.time()}
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        ccm.pool_key = key
+        self._get_local_sessions()[key] = ccm
+        if ccm.is_registered():
+            # The session belongs to the pool, not to the process that happened to start it
+            get_session_registry().claim(ccm.getCCM_ADDR(), self.owner)
+        return key
+
+    def _start_session(self):
+        logger.info("Starting an extra session, %d running" % len(self.sessions))
+        ccm = SynergySession(self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, offline=self.offline, channel=self.channel)
+        ccm.keep_session_alive = True
+        self._add_session(ccm, free=False)
+        return ccm
+
+    def _get_local_sessions(self):
+        if self.local_pid != os.getpid():
+            self.local_sessions = {}
+            self.local_pid = os.getpid()
+        return self.local_sessions
+
+    def _get_session(self, key, addr):
+        """The session object of key in this process"""
+        local_sessions = self._get_local_sessions()
+        if key not in local_sessions:
+            ccm = SynergySession(self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, ccm_addr=addr, offline=self.offline, channel=self.channel)
+            ccm.keep_session_alive = True
+            ccm.pool_key = key
+            local_sessions[key] = ccm
+        return local_sessions[key]
+
+    def _discard(self, key):
+        self.condition.acquire()
+        try:
+            entry = self.sessions.pop(key, None)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        if entry:
+            self._stop_session(key, entry['addr'])
+
+    def _reap_idle(self):
+        """Stop the sessions idle for more than idle_timeout, they would hold an engine slot for nothing"""
+        reaped = []
+        self.condition.acquire()
+        try:
+            now = time.time()
+            idle = sorted([(entry['last_used'], key) for key, entry in self.sessions.items()
+                           if entry['free'] and now - entry['last_used'] > self.idle_timeout])
+            for last_used, key in idle:
+                if len(self.sessions) <= self.min_sessions:
+                    break
+                reaped.append((key, self.sessions.pop(key)))
+        finally:
+            self.condition.release()
+        for key, entry in reaped:
+            logger.info("Stopping session %s, idle for %d s" % (entry['addr'], time.time() - entry['last_used']))
+            self._stop_session(key, entry['addr'])
+
+    def _stop_session(self, key, addr, keep=False):
+        registry = get_session_registry()
+        ccm = self._get_local_sessions().pop(key, None)
+        if keep and registry is not None and addr in registry.get_sessions():
+            # Keep it for the next run
+            registry.release(addr)
+            if ccm is not None:
+                ccm.keep_session_alive = True
+                ccm._close_channel()
+            return
+        try:
+            if ccm is None:
+                ccm = SynergySession(self.database, self.engine, self.command_name, self.ccm_ui_path, self.ccm_eng_path, ccm_addr=addr, offline=self.offline)
+            ccm.keep_session_alive = True
+            ccm.stop()
+            if registry is not None:
+                registry.remove(addr)
+        except (OSError, SynergyException), e:
+            logger.warning("Couldn't stop session %s: %s" % (addr, e))
+
+class LocalValue(object):
+    """Holds a value like a manager's Value, for a pool used by one process"""
+    def __init__(self, value):
+        self.value = value
+
+def create_sessions_pool(nr_sessions, database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, session_cls, channel=None):
     session_array = {}
     pool = Pool(nr_sessions)
     for i in range(nr_sessions):
-        pool.apply_async(create_session, (database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, i), callback=session_cls.put_session )
+        pool.apply_async(create_session, (database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, i, channel), callback=session_cls.put_session )
         if offline:
             print "Offline mode, just using cache"
         else:
@@ -85,8 +494,8 @@ def create_sessions_pool(nr_sessions, database, engine, command_name, ccm_ui_pat
 
     pool.join()
 
-def create_session(database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, i):
-    ccm = SynergySession(database, engine, command_name, ccm_ui_path, ccm_eng_path, offline)
+def create_session(database, engine, command_name, ccm_ui_path, ccm_eng_path, offline, i, channel=None):
+    ccm = SynergySession(database, engine, command_name, ccm_ui_path, ccm_eng_path, offline=offline, channel=channel)
     ccm.keep_session_alive = True
     ccm.sessionID = i
     return (i,ccm)
@@ -97,6 +506,15 @@ def do_query(task, ccm, queue):
     queue.put(result)
     queue.close()
 
+class SynergySessionsException(Exception):
+    """User defined exception raised by SynergySessions"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
 def main():
     pass
 if __name__ == '__main__':
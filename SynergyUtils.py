@@ -20,10 +20,10 @@ FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.    IN NO EVENT SHALL THE COPYRI
 (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
 CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
-import cPickle
 
 import SynergyObject
 import ccm_cache
+from load_configuration import get_config
 import re
 import logging as logger
 from itertools import product
@@ -361,8 +361,4 @@ class ObjectHistory(object):
         return ret_val
 
     def load_max_recursion_depth(self):
-        f = open('config.p', 'rb')
-        config = cPickle.load(f)
-        f.close()
-
-        return config['max_recursion_depth']
\ No newline at end of file
+        return get_config()['max_recursion_depth']
\ No newline at end of file
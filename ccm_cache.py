@@ -28,26 +28,46 @@ from ProjectObject import ProjectObject
 from FileObject import FileObject
 from SynergySession import SynergySession, SynergyException
 from TaskObject import TaskObject
+from MetadataStore import create_metadata_store
+from ObjectCache import get_object_cache
+from BlobStore import BlobStore, BLOBS_DIR, map_file
+from NegativeCache import create_negative_cache, QUERY_FAILED, NOT_FOUND
+from ObjectLocks import ObjectLocks, LOCK_FILENAME
+from load_configuration import get_config, has_config
 
 import string
-import cPickle
+import time
+# datetime.strptime imports this lazily, which fails when threads call it first
+import _strptime
 import hashlib
+import sqlite3
+import threading
 import os
 import os.path
 import logging
 
 logger = logging.getLogger("ccm_cache")
 
-def validate_object_data(object_data, ccm_cache_path, ccm):
-    """ Check predecessors etc for correct successor information"""
-    for predecessor_name in object_data.predecessors:
-        try:
-            predecessor = get_object_data_from_cache(predecessor_name, ccm_cache_path)
-        except ObjectCacheException:
-            return
-        if object_data.get_object_name() not in predecessor.successors:
-            predecessor.successors.append(object_data.get_object_name())
-            force_cache_update_for_object(predecessor,ccm_cache_path=ccm_cache_path)
+# Objects validated with an older epoch are validated again, increase it when validate_object_data changes
+VALIDATION_EPOCH = 1
+
+def is_validated(object_data, ccm=None):
+    """If validate_object_data has nothing left to do for object_data and the database of ccm"""
+    if getattr(object_data, 'validation_epoch', None) != VALIDATION_EPOCH:
+        return False
+    return not ccm or ccm.get_database_name() in getattr(object_data, 'info_databases', [])
+
+def validate_object_data(object_data, ccm_cache_path, ccm, relations=None):
+    """ Check predecessors etc for correct successor information
+        relations can hold predecessors and successors already fetched by get_relations
+
+        This is done once per object and database: the object is marked with
+        VALIDATION_EPOCH when all its predecessors list it as successor, and
+        gets the database of ccm in info_databases when its info from there is
+        merged, after that validating it reads nothing """
+    if is_validated(object_data, ccm):
+        return
+    changed = False
     if ccm:
         ccm_db = ccm.get_database_name()
         try:
@@ -57,9 +77,101 @@ def validate_object_data(object_data, ccm_cache_path, ccm):
             object_data.info_databases = []
 
         if ccm_db not in object_data.info_databases:
-            # Get info from new db and update the cache
-            object = update_object_cache_with_new_ccm_db_info(object_data, ccm)
-            force_cache_update_for_object(object, ccm_cache_path=ccm_cache_path)
+            # Get info from new db, the predecessors found there need their successors checked
+            update_object_cache_with_new_ccm_db_info(object_data, ccm, relations)
+            object_data.validation_epoch = None
+            changed = True
+    if getattr(object_data, 'validation_epoch', None) != VALIDATION_EPOCH:
+        if link_predecessors(object_data, ccm_cache_path):
+            object_data.validation_epoch = VALIDATION_EPOCH
+            changed = True
+    if changed:
+        store = get_metadata_store(ccm_cache_path)
+        with get_object_locks(ccm_cache_path).locked([object_data.get_object_name()]):
+            # Other threads and processes may have added relations to the stored copy since object_data was read
+            cached = store.get(object_data.get_object_name())
+            if cached is not None:
+                if set(cached.predecessors) - set(object_data.predecessors):
+                    # Linked when object_data is validated again
+                    object_data.validation_epoch = None
+                for k in ('predecessors', 'successors', 'info_databases'):
+                    names = getattr(object_data, k, [])
+                    added = [o for o in getattr(cached, k, []) if o not in names]
+                    if added:
+                        setattr(object_data, k, names + added)
+            force_cache_update_for_object(object_data, ccm_cache_path=ccm_cache_path)
+            store.flush()
+
+def link_predecessors(object_data, ccm_cache_path):
+    """Add object_data to the successors of its predecessors
+
+    Returns False when a predecessor isn't in the cache yet, it is linked when
+    object_data is validated again"""
+    name = object_data.get_object_name()
+    unlinked = []
+    for predecessor_name in object_data.predecessors:
+        try:
+            predecessor = get_object_data_from_cache(predecessor_name, ccm_cache_path)
+        except ObjectCacheException:
+            # It may have been stored by another process since
+            unlinked.append(predecessor_name)
+            continue
+        if name not in predecessor.successors:
+            unlinked.append(predecessor_name)
+    if not unlinked:
+        return True
+
+    def link(predecessor):
+        if name in predecessor.successors:
+            return False
+        predecessor.successors.append(name)
+        return True
+    linked = update_cached_objects(unlinked, ccm_cache_path, link)
+    return len(linked) == len(unlinked)
+
+def update_cached_objects(names, ccm_cache_path, update):
+    """Apply update to the cached objects of names as they are stored now, and write back those it returns True for
+
+    The objects are locked meanwhile, see ObjectLocks, so the changes other
+    threads and processes made since they were read aren't lost. Returns
+    {name: object} of the objects of names in the cache"""
+    store = get_metadata_store(ccm_cache_path)
+    with get_object_locks(ccm_cache_path).locked(names):
+        objects = store.get_many(names, refresh=True)
+        for object in objects.values():
+            if update(object):
+                force_cache_update_for_object(object, ccm_cache_path=ccm_cache_path)
+        # Commit them before the locks are released, so the waiting processes find them
+        store.flush()
+    return objects
+
+def validate_cache(ccm=None, object_names=None, ccm_cache_path=None):
+    """Validate the cached objects of object_names, all objects in the cache when None
+
+    Objects validated already are only read. Returns the number of objects
+    validated now"""
+    if ccm_cache_path is None:
+        ccm_cache_path = load_ccm_cache_path()
+    store = get_metadata_store(ccm_cache_path)
+    relations = {}
+    if object_names is None:
+        objects = store.iter_objects()
+    else:
+        objects = store.get_many(set(object_names)).values()
+        if ccm:
+            ccm_db = ccm.get_database_name()
+            new_db = [o.get_object_name() for o in objects if ccm_db not in getattr(o, 'info_databases', [])]
+            if new_db:
+                relations = get_relations(new_db, ccm)
+    checked = 0
+    validated = 0
+    for object_data in objects:
+        checked += 1
+        if not is_validated(object_data, ccm):
+            validate_object_data(object_data, ccm_cache_path, ccm, relations)
+            validated += 1
+    logger.info("Validated %d of %d cached objects", validated, checked)
+    return validated
 
 
 def get_object(obj, ccm=None):
@@ -86,6 +198,74 @@ def get_object(obj, ccm=None):
             raise ObjectCacheException("Couldn't extract %s from Synergy" % obj)
     return object_data
 
+def get_objects(object_names, ccm=None):
+    """Get the meta data of many objects, returns a dict {four-part-name: object}
+
+    Objects not in the cache are fetched from ccm in batches, objects that
+    can't be found in Synergy are left out"""
+    ccm_cache_path = load_ccm_cache_path()
+    object_cache = get_object_cache()
+    objects = {}
+    for obj in set(object_names):
+        object_data = object_cache.get(obj)
+        if object_data is not None:
+            objects[obj] = object_data
+    loaded = get_metadata_store(ccm_cache_path).get_many([obj for obj in set(object_names) if obj not in objects])
+    for object_data in loaded.values():
+        object_cache.put(object_data)
+    objects.update(loaded)
+    missing = [obj for obj in set(object_names) if obj not in objects]
+    relations = {}
+    if ccm:
+        # Objects which haven't seen this database yet need its relations
+        ccm_db = ccm.get_database_name()
+        new_db = [k for k, v in objects.iteritems() if ccm_db not in getattr(v, 'info_databases', [])]
+        if new_db:
+            relations = get_relations(new_db, ccm)
+    for object_data in objects.values():
+        validate_object_data(object_data, ccm_cache_path, ccm, relations)
+    if missing:
+        if not ccm:
+            try:
+                ccm = create_ccm_session_from_config()
+            except OSError:
+                #couldn't start Synergy on this computer
+                raise ObjectCacheException("Couldn't start Synergy")
+        objects.update(get_objects_from_ccm(missing, ccm, ccm_cache_path))
+    return objects
+
+def prefetch(object_names, ccmpool, batch_size=100):
+    """Fetch the objects of object_names missing in the cache from Synergy, on all sessions of ccmpool at once
+
+    The missing objects are fetched in batches of batch_size, meta data and
+    source. Returns the number of objects fetched"""
+    if ccmpool is None:
+        return 0
+    ccm_cache_path = load_ccm_cache_path()
+    names = set([o for o in object_names if o])
+    missing = sorted(names - get_metadata_store(ccm_cache_path).existing(names))
+    if not missing:
+        return 0
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    logger.info("Prefetching %d of %d objects in %d batches", len(missing), len(names), len(batches))
+    start = time.time()
+    fetched = 0
+    for done, count in enumerate(ccmpool.map(prefetch_batch, batches)):
+        fetched += count
+        logger.info("Prefetched %d/%d batches, %d objects, %.1f objects/s", done + 1, len(batches), fetched, fetched / max(time.time() - start, 0.001))
+    return fetched
+
+def prefetch_batch(ccm, object_names):
+    """Fetch object_names from Synergy on ccm, returns the number of objects fetched
+
+    A batch which fails is logged and counted as none fetched, the objects
+    are fetched again when they are needed"""
+    try:
+        return len(get_objects_from_ccm(object_names, ccm, load_ccm_cache_path()))
+    except (ObjectCacheException, SynergyException, EnvironmentError, sqlite3.Error), e:
+        logger.warning("Couldn't prefetch %d objects: %s", len(object_names), e)
+        return 0
+
 def get_source(obj, ccm=None):
     """Get the object source from either the cache or directly from ccm"""
     if obj is None:
@@ -105,6 +285,26 @@ def get_source(obj, ccm=None):
 
     return object
 
+def open_source(obj, ccm=None):
+    """Get the object source from either the cache or directly from ccm, as (length, chunks)
+
+    chunks is a list of strings and buffers on memory mapped files, write
+    them out one after the other instead of joining them"""
+    if obj is None:
+        return None
+    ccm_cache_path = load_ccm_cache_path()
+    #try the object cache first
+    try:
+        return open_object_source_from_cache(obj, ccm_cache_path)
+    except ObjectCacheException:
+        if not ccm:
+            ccm = create_ccm_session_from_config()
+        try:
+            get_object_from_ccm(obj, ccm, ccm_cache_path)
+        except ObjectCacheException:
+            raise ObjectCacheException("Couldn't extract source of %s from Synergy" % obj)
+        return open_object_source_from_cache(obj, ccm_cache_path)
+
 def reload_object(obj, ccm=None):
     ccm_cache_path = load_ccm_cache_path()
     # delete it:
@@ -120,11 +320,10 @@ def delete_object(obj):
     if obj is None:
         return None
     ccm_cache_path = load_ccm_cache_path()
+    get_object_cache().invalidate(obj)
+    get_negative_cache(ccm_cache_path).forget(obj)
+    get_metadata_store(ccm_cache_path).delete(obj)
     dir, filename = get_path_for_object(obj, ccm_cache_path)
-    datafile = filename + '_data'
-    if os.path.exists(datafile):
-        #delete it
-        os.remove(datafile)
     if os.path.exists(filename):
         os.remove(filename)
 
@@ -136,32 +335,119 @@ def get_path_for_object(obj, ccm_cache_path):
     filename = dir + '/' + sha[2:-1]
     return dir, filename
 
+# ccm_cache_path -> the metadata store of that cache
+_metadata_stores = {}
+
+def get_metadata_store(ccm_cache_path):
+    """The store of the objects' meta data, as chosen by ccm_cache_backend, see MetadataStore"""
+    if ccm_cache_path not in _metadata_stores:
+        _metadata_stores[ccm_cache_path] = create_metadata_store(load_ccm_cache_backend(), ccm_cache_path)
+    return _metadata_stores[ccm_cache_path]
+
+def flush_metadata_stores():
+    """Commit the meta data buffered by the stores of this process, and save their indexes and the negative caches"""
+    for store in _metadata_stores.values():
+        store.flush()
+        store.save_index()
+    for blob_store in _blob_stores.values():
+        blob_store.save_index()
+    for negative_cache in _negative_caches.values():
+        negative_cache.save()
+
+# ccm_cache_path -> the negative cache of that cache
+_negative_caches = {}
+
+def get_negative_cache(ccm_cache_path=None):
+    """The objects Synergy couldn't return, see NegativeCache
+
+    Objects not found expire after ccm_negative_ttl seconds, failed queries after ccm_negative_failed_ttl"""
+    if ccm_cache_path is None:
+        ccm_cache_path = load_ccm_cache_path()
+    if ccm_cache_path not in _negative_caches:
+        _negative_caches[ccm_cache_path] = create_negative_cache(ccm_cache_path, get_config())
+    return _negative_caches[ccm_cache_path]
+
+# ccm_cache_path -> the object locks of that cache
+_object_locks = {}
+_object_locks_lock = threading.Lock()
+
+def get_object_locks(ccm_cache_path=None):
+    """The locks serializing the fetches of an object from Synergy into the cache, see ObjectLocks"""
+    if ccm_cache_path is None:
+        ccm_cache_path = load_ccm_cache_path()
+    with _object_locks_lock:
+        if ccm_cache_path not in _object_locks:
+            if not os.path.exists(ccm_cache_path):
+                try:
+                    os.makedirs(ccm_cache_path)
+                except OSError:
+                    # just continue if it is already there
+                    pass
+            _object_locks[ccm_cache_path] = ObjectLocks(os.path.join(ccm_cache_path, LOCK_FILENAME))
+        return _object_locks[ccm_cache_path]
+
 def get_object_data_from_cache(obj, ccm_cache_path):
     """Try to get the object's meta data from the cache"""
-    #sha1 the object name:
-    dir, filename = get_path_for_object(obj, ccm_cache_path)
-    datafile = filename + '_data'
-    # check if object exists
-    if os.path.exists(datafile):
-        # load the data file
-#        print 'Loading object %s from cache' %obj
-        f = open(datafile, 'rb')
-        object_data = cPickle.load(f)
-        f.close()
+    object_data = get_object_cache().get(obj)
+    if object_data is not None:
         return object_data
-    else:
+    object_data = get_metadata_store(ccm_cache_path).get(obj)
+    if object_data is None:
         raise ObjectCacheException("Object %s not in cache" %obj)
+    get_object_cache().put(object_data)
+    return object_data
+
+# ccm_cache_path -> the blob store of that cache
+_blob_stores = {}
+
+def get_blob_store(ccm_cache_path):
+    if ccm_cache_path not in _blob_stores:
+        _blob_stores[ccm_cache_path] = BlobStore(os.path.join(ccm_cache_path, BLOBS_DIR))
+    return _blob_stores[ccm_cache_path]
+
+def get_content_hash(obj, ccm_cache_path=None):
+    """The git blob id of the object's source, None if its source isn't in the blob store"""
+    if ccm_cache_path is None:
+        ccm_cache_path = load_ccm_cache_path()
+    try:
+        object_data = get_object_data_from_cache(obj, ccm_cache_path)
+    except ObjectCacheException:
+        return None
+    return getattr(object_data, 'content_hash', None)
+
+def has_cached_content(object, ccm_cache_path):
+    """If the source of object is in the blob store, or in a file of a cache from before the blob store"""
+    content_hash = getattr(object, 'content_hash', None)
+    if content_hash and get_blob_store(ccm_cache_path).exists(content_hash):
+        return True
+    return os.path.exists(get_path_for_object(object.get_object_name(), ccm_cache_path)[1])
+
+def store_content(object, ccm, ccm_cache_path):
+    """Put the source of object into the blob store and reference it from the object"""
+    content = get_content(object, ccm)
+    object.content_hash = get_blob_store(ccm_cache_path).put(content)
 
 def get_object_source_from_cache(obj, ccm_cache_path):
     """Try to get the object from the cache"""
+    length, chunks = open_object_source_from_cache(obj, ccm_cache_path)
+    return ''.join([str(chunk) for chunk in chunks])
+
+def open_object_source_from_cache(obj, ccm_cache_path):
+    """Try to get the object's source from the cache as (length, chunks), see BlobStore.open"""
+    content_hash = get_content_hash(obj, ccm_cache_path)
+    if content_hash:
+        opened = get_blob_store(ccm_cache_path).open(content_hash)
+        if opened is not None:
+            return opened
+    # Caches from before the blob store have the source in a file of its own
     dir, filename = get_path_for_object(obj, ccm_cache_path)
     # check if object exists
     if os.path.exists(filename):
-        # load the file
         f = open(filename, 'rb')
-        content = f.read()
-        f.close()
-        return content
+        try:
+            return map_file(f)
+        finally:
+            f.close()
     else:
         raise ObjectCacheException("Object %s not in cache" %obj)
 
@@ -169,58 +455,31 @@ def get_object_source_from_cache(obj, ccm_cache_path):
 def force_cache_update_for_object(object, ccm=None, ccm_cache_path=None):
     if ccm_cache_path is None:
         ccm_cache_path = load_ccm_cache_path()
-    dir, filename = get_path_for_object(object.get_object_name(), ccm_cache_path)
-    datafile = filename + '_data'
-    # check if object exists
-    if os.path.exists(datafile):
-        #delete it
-        os.remove(datafile)
-    if not os.path.exists(dir):
-        try:
-           os.makedirs(dir)
-        except OSError:
-            # just continue if it is already there
-            pass
-    f = open(datafile, 'wb')
-    cPickle.dump(object, f)
-    f.close()
-
     type = object.get_type()
     if type != 'project' and type != 'task' and type != 'dir':
         # Store the content of the object
-        if not os.path.exists(filename):
+        if not has_cached_content(object, ccm_cache_path):
             if ccm is None:
                 ccm = create_ccm_session_from_config()
-            content = get_content(object, ccm)
-            f = open(filename, 'wb')
-            f.write(content)
-            f.close()
+            store_content(object, ccm, ccm_cache_path)
+
+    get_object_cache().invalidate(object.get_object_name())
+    get_metadata_store(ccm_cache_path).put(object)
 
 
 def update_cache(object, ccm, ccm_cache_path):
-    dir, filename = get_path_for_object(object.get_object_name(), ccm_cache_path)
-    datafile = filename + '_data'
+    store = get_metadata_store(ccm_cache_path)
     # check if object exists
-    if os.path.exists(datafile):
+    if store.exists(object.get_object_name()):
         raise ObjectCacheException("Object %s is already in cache" %object)
-    else:
-        if not os.path.exists(dir):
-            try:
-               os.makedirs(dir)
-            except OSError:
-                # just continue if it is already there
-                pass
-        f = open(datafile, 'wb')
-        cPickle.dump(object, f)
-        f.close()
 
     type = object.get_type()
     if type != 'project' and type != 'task' and type != 'dir':
         # Store the content of the object
-        content = get_content(object, ccm)
-        f = open(filename, 'wb')
-        f.write(content)
-        f.close()
+        store_content(object, ccm, ccm_cache_path)
+
+    get_object_cache().invalidate(object.get_object_name())
+    store.put(object)
 
 def create_project_object(synergy_object, ccm):
     object = ProjectObject(synergy_object.get_object_name(), synergy_object.get_separator(), synergy_object.get_author(), synergy_object.get_status(), synergy_object.get_created_time(), synergy_object.get_tasks())
@@ -267,30 +526,154 @@ def fill_changed_entries(object, ccm):
     object.set_deleted_objects(set(deleted_objs))
     return object
 
+OBJECT_INFO_FORMAT = ["%objectname", "%owner", "%status", "%create_time", "%task"]
+
 def get_object_from_ccm(four_part_name, ccm, ccm_cache_path):
-    """Try to get the object's meta data from Synergy"""
+    """Try to get the object's meta data from Synergy
+
+    Only one thread or process fetches an object at a time, see ObjectLocks,
+    the others get the object it stored"""
+    locks = get_object_locks(ccm_cache_path)
+    with locks.locked([four_part_name]):
+        # It may have been fetched while we waited for the lock
+        store = get_metadata_store(ccm_cache_path)
+        object_data = store.get(four_part_name)
+        if object_data is not None:
+            locks.add_coalesced(1)
+            return object_data
+        object_data = fetch_object_from_ccm(four_part_name, ccm, ccm_cache_path)
+        # Commit it before the lock is released, so the waiting processes find it
+        store.flush()
+        return object_data
+
+def fetch_object_from_ccm(four_part_name, ccm, ccm_cache_path):
+    negative_cache = get_negative_cache(ccm_cache_path)
+    failed = negative_cache.lookup(four_part_name, ccm.get_database_name())
+    if failed:
+        raise ObjectCacheException("Couldn't fetch %s from Synergy before (%s): %s" % (four_part_name, failed['reason'], failed['message']))
     # convert the four-part-name to a synergy object:
     delim = ccm.delim()
     synergy_object = SynergyObject(four_part_name, delim)
     try:
-        res = ccm.query("name='{0}' and version='{1}' and type='{2}' and instance='{3}'".format(synergy_object.get_name(), synergy_object.get_version(), synergy_object.get_type(), synergy_object.get_instance())).format("%objectname").format("%owner").format("%status").format("%create_time").format("%task").run()
-    except SynergyException:
+        res = ccm.query(object_info_query(synergy_object)).format("%objectname").format("%owner").format("%status").format("%create_time").format("%task").run()
+    except SynergyException, e:
+        negative_cache.record(four_part_name, ccm.get_database_name(), QUERY_FAILED, str(e))
         raise ObjectCacheException("Couldn't query four-part-name of %s from Synergy" % four_part_name)
     if res:
-        synergy_object.status = res[0]['status']
-        synergy_object.author =  res[0]['owner']
-        synergy_object.created_time = datetime.strptime(res[0]['create_time'], "%a %b %d %H:%M:%S %Y")
-        tasks = []
-        for t in res[0]['task'].split(','):
-            if t != '<void>':
-                if ':task:' not in t:
-                    tasks.append(task_to_four_part(t, delim))
-                else:
-                    tasks.append(t)
-        synergy_object.tasks = tasks
+        fill_object_info(synergy_object, res[0], delim)
     else:
+        negative_cache.record(four_part_name, ccm.get_database_name(), NOT_FOUND, "No object found")
         raise ObjectCacheException("Couldn't extract %s's info from Synergy" % four_part_name)
 
+    return create_object(synergy_object, ccm, ccm_cache_path)
+
+def get_objects_from_ccm(four_part_names, ccm, ccm_cache_path):
+    """Get the meta data of many objects from Synergy, returns a dict {four-part-name: object}
+
+    The basic info of all the objects is fetched with a few combined queries.
+    Objects which can't be fetched are logged and left out, objects Synergy
+    couldn't return before are skipped, see NegativeCache.
+    The objects are locked while they are fetched, see get_object_from_ccm"""
+    locks = get_object_locks(ccm_cache_path)
+    relations = {}
+    with locks.locked(four_part_names):
+        # Some may have been fetched while we waited for the locks, by other processes as well
+        store = get_metadata_store(ccm_cache_path)
+        objects = store.get_many(four_part_names, refresh=True)
+        locks.add_coalesced(len(objects))
+        missing = [o for o in set(four_part_names) if o not in objects]
+        if missing:
+            fetched, relations = fetch_objects_from_ccm(missing, ccm, ccm_cache_path)
+            objects.update(fetched)
+            # Commit them before the locks are released, so the waiting processes find them
+            store.flush()
+    # hist also reported the relations of other versions, add them to those already in the cache.
+    # They are locked on their own, after the locks above are released, so no two fetches wait for each other
+    store_relations(relations, ccm_cache_path, exclude=objects.keys())
+    return objects
+
+def fetch_objects_from_ccm(four_part_names, ccm, ccm_cache_path):
+    """Fetch and store the objects of four_part_names, returns ({four-part-name: object}, relations)
+
+    relations are those reported by hist, of other versions as well, see get_relations"""
+    negative_cache = get_negative_cache(ccm_cache_path)
+    database = ccm.get_database_name()
+    four_part_names = [o for o in four_part_names if not negative_cache.lookup(o, database)]
+    if not four_part_names:
+        return {}, {}
+    delim = ccm.delim()
+    synergy_objects = {}
+    for four_part_name in four_part_names:
+        synergy_objects[four_part_name] = SynergyObject(four_part_name, delim)
+    failed = {}
+    res = query_object_info(synergy_objects.values(), ccm, failed)
+    for four_part_name, message in failed.iteritems():
+        negative_cache.record(four_part_name, database, QUERY_FAILED, message)
+
+    relations = get_relations([row['objectname'] for row in res], ccm)
+    found = dict([(row['objectname'], row) for row in res if row['objectname'] in synergy_objects])
+    attributes = get_attributes_of_objects([synergy_objects[name] for name in found.keys()], ccm)
+    objects = {}
+    for name, row in found.iteritems():
+        synergy_object = synergy_objects[name]
+        fill_object_info(synergy_object, row, delim)
+        try:
+            objects[name] = create_object(synergy_object, ccm, ccm_cache_path, relations, attributes)
+        except (SynergyException, ObjectCacheException), e:
+            logger.warning("Couldn't create %s from Synergy: %s", name, e)
+
+    if failed:
+        logger.warning("Couldn't query info of %s from Synergy", ', '.join(sorted(failed.keys())))
+    not_found = set(synergy_objects.keys()) - set(found.keys()) - set(failed.keys())
+    if not_found:
+        logger.warning("Couldn't extract info of %s from Synergy", ', '.join(sorted(not_found)))
+        for four_part_name in not_found:
+            negative_cache.record(four_part_name, database, NOT_FOUND, "No object found")
+    return objects, relations
+
+def query_object_info(synergy_objects, ccm, failed, batch_size=100):
+    """The info rows of synergy_objects, see OBJECT_INFO_FORMAT, queried batch_size at a time
+
+    A failing query is split in halves and retried, down to single objects,
+    so one bad name doesn't cost the rest of its batch. The names whose own
+    query failed are added to failed, {four-part-name: error message}"""
+    if len(synergy_objects) > batch_size:
+        rows = []
+        for i in range(0, len(synergy_objects), batch_size):
+            rows.extend(query_object_info(synergy_objects[i:i + batch_size], ccm, failed, batch_size))
+        return rows
+    try:
+        return ccm.query_many([object_info_query(o) for o in synergy_objects], OBJECT_INFO_FORMAT, batch_size)
+    except SynergyException, e:
+        if len(synergy_objects) == 1:
+            failed[synergy_objects[0].get_object_name()] = str(e)
+            return []
+        half = len(synergy_objects) / 2
+        return (query_object_info(synergy_objects[:half], ccm, failed, batch_size) +
+                query_object_info(synergy_objects[half:], ccm, failed, batch_size))
+
+def object_info_query(synergy_object):
+    return "name='{0}' and version='{1}' and type='{2}' and instance='{3}'".format(synergy_object.get_name(), synergy_object.get_version(), synergy_object.get_type(), synergy_object.get_instance())
+
+def fill_object_info(synergy_object, info, delim):
+    """Set owner, status, create time and tasks of synergy_object from a query result row"""
+    synergy_object.status = info['status']
+    synergy_object.author = info['owner']
+    synergy_object.created_time = datetime.strptime(info['create_time'], "%a %b %d %H:%M:%S %Y")
+    tasks = []
+    for t in info['task'].split(','):
+        if t != '<void>':
+            if ':task:' not in t:
+                tasks.append(task_to_four_part(t, delim))
+            else:
+                tasks.append(t)
+    synergy_object.tasks = tasks
+
+def create_object(synergy_object, ccm, ccm_cache_path, relations=None, attributes=None):
+    """Create the cache object of the right type from synergy_object, fetch its relations and store it
+
+    Predecessors and successors are taken from relations when present, see get_relations,
+    and the attributes from attributes, see get_attributes_of_objects"""
     if synergy_object.get_type() == 'project':
         object = create_project_object(synergy_object, ccm)
     elif synergy_object.get_type() == 'task':
@@ -298,10 +681,11 @@ def get_object_from_ccm(four_part_name, ccm, ccm_cache_path):
     else:
         object = create_file_or_dir_object(synergy_object, ccm)
     # Common among all objects
-    object.predecessors = get_predecessors(object, ccm)
-    object.successors = get_successors(object, ccm)
-    attributes = get_non_blacklisted_attributes(object, ccm)
-    object.set_attributes(attributes)
+    object.predecessors, object.successors = get_predecessors_and_successors(object, ccm, relations)
+    if attributes is not None and object.get_object_name() in attributes:
+        object.set_attributes(attributes[object.get_object_name()])
+    else:
+        object.set_attributes(get_non_blacklisted_attributes(object, ccm))
 
     if object.get_type() == 'dir':
         object = fill_changed_entries(object, ccm)
@@ -312,35 +696,12 @@ def get_object_from_ccm(four_part_name, ccm, ccm_cache_path):
 
     return object
 
-def update_object_cache_with_new_ccm_db_info(object, ccm):
+def update_object_cache_with_new_ccm_db_info(object, ccm, relations=None):
     # the difference should primarily be in objects' relations
     # check if object exists in db at all
     try:
-        exists = ccm.query("name='{0}' and version='{1}' and type='{2}' and instance='{3}'".format(object.name, object.version, object.type, object.instance)).format("%objectname").run()
-        predecessors = get_predecessors(object, ccm)
-        object.predecessors = list(set(object.predecessors + predecessors))
-        successors = get_successors(object, ccm)
-        object.successors = list(set(object.successors + successors))
-
-        if object.get_type() == 'project':
-            baseline_predecessor = get_baseline_predecessor(object, ccm)
-            if baseline_predecessor:
-                object.baseline_predecessor = list(set(object.baseline_predecessor + [baseline_predecessor]))
-            baseline_successor = get_baseline_successor(object, ccm)
-            if baseline_successor:
-                object.baseline_successor = list(set(object.baseline_successor + baseline_successor))
-            tasks_in_rp = get_tasks_in_reconfigure_prop(object, ccm)
-            object.tasks_in_rp = list(set(object.tasks_in_rp + tasks_in_rp))
-            baselines = get_baselines_for_project(object, ccm)
-            object.baselines = list(set(object.baselines + baselines))
-        elif object.get_type() == 'task':
-            released_projects = get_projects_for_task(object, ccm)
-            object.released_projects = list(set(object.released_projects + released_projects))
-            baselines = get_baselines_for_task(object, ccm)
-            object.baselines = list(set(object.baselines + baselines))
-        else:
-            releases = get_releases(object, ccm)
-            object.releases = list(set(object.releases + releases))
+        exists = ccm.query(object_info_query(object)).format("%objectname").run()
+        merge_object_info(object, get_object_info_in_database(object, ccm, relations))
     except SynergyException:
         logger.warning("Couldn't fetch {0} from {1}".format(object.get_object_name(), ccm.get_database_name()))
         pass
@@ -349,6 +710,144 @@ def update_object_cache_with_new_ccm_db_info(object, ccm):
 
     return object
 
+def get_object_info_in_database(object, ccm, relations=None, row=None):
+    """Get the relations of object in the database of ccm, returns {attribute of object: [object names]}
+
+    row is the row of object in the batched lookup of get_objects_info_in_database,
+    its release and baseline are taken from there instead of being queried"""
+    predecessors, successors = get_predecessors_and_successors(object, ccm, relations)
+    info = {'predecessors': predecessors, 'successors': successors}
+    if object.get_type() == 'project':
+        if row is not None:
+            baseline_predecessor = row['baseline'] != '<void>' and row['baseline'] or None
+        else:
+            baseline_predecessor = get_baseline_predecessor(object, ccm)
+        info['baseline_predecessor'] = baseline_predecessor and [baseline_predecessor] or []
+        info['baseline_successor'] = get_baseline_successor(object, ccm)
+        info['tasks_in_rp'] = get_tasks_in_reconfigure_prop(object, ccm)
+        info['baselines'] = get_baselines_for_project(object, ccm)
+    elif object.get_type() == 'task':
+        info['released_projects'] = get_projects_for_task(object, ccm)
+        info['baselines'] = get_baselines_for_task(object, ccm)
+    elif row is not None:
+        info['releases'] = row['release'] != '<void>' and [row['release']] or []
+    else:
+        info['releases'] = get_releases(object, ccm)
+    return info
+
+def merge_object_info(object, info):
+    """Add the relations found in another database, as returned by get_object_info_in_database, to object"""
+    for k, names in info.iteritems():
+        if names:
+            if k == 'predecessors' and set(names) - set(object.predecessors):
+                # The new predecessors need their successors checked
+                object.validation_epoch = None
+            setattr(object, k, list(set(getattr(object, k) + names)))
+
+def merge_database_info(object_names, databases, ccm_cache_path=None):
+    """Merge the relations of the cached objects object_names from all databases of databases, a SynergyDatabases
+
+    All databases are queried at once, each for all the objects which haven't
+    seen it yet, and every changed object is written once. Afterwards
+    validate_object_data has nothing left to merge for these databases.
+    Objects not in the cache are skipped. Returns the number of objects changed"""
+    if ccm_cache_path is None:
+        ccm_cache_path = load_ccm_cache_path()
+    objects = get_metadata_store(ccm_cache_path).get_many(set(object_names))
+    for object in objects.values():
+        if not hasattr(object, 'info_databases'):
+            object.info_databases = []
+
+    results = databases.map(get_objects_info_in_database, objects.values())
+    # name -> [(database, info)] to merge
+    merges = {}
+    for database, infos in results.iteritems():
+        for name, info in infos.iteritems():
+            merges.setdefault(name, []).append((database, info))
+
+    def merge(object):
+        if not hasattr(object, 'info_databases'):
+            object.info_databases = []
+        for database, info in merges[object.get_object_name()]:
+            if database in object.info_databases:
+                continue
+            if info:
+                merge_object_info(object, info)
+            object.info_databases.append(database)
+        return True
+    # Merged into the objects as stored now, others may have changed them since they were read
+    return len(update_cached_objects(merges.keys(), ccm_cache_path, merge))
+
+# The fields of the batched lookup of get_objects_info_in_database
+OBJECT_DATABASE_INFO_FORMAT = ['%objectname', '%release', '%baseline']
+
+def get_objects_info_in_database(ccm, objects):
+    """Get the relations of the objects which haven't seen the database of ccm yet
+
+    Returns {four-part-name: info}, see get_object_info_in_database, info is
+    None for the objects which don't exist in the database"""
+    database = ccm.get_database_name()
+    todo = [o for o in objects if database not in o.info_databases]
+    if not todo:
+        return {}
+    rows = ccm.query_many([object_info_query(o) for o in todo], OBJECT_DATABASE_INFO_FORMAT)
+    existing = dict([(row['objectname'], row) for row in rows])
+    relations = get_relations(existing.keys(), ccm)
+    infos = {}
+    for o in todo:
+        if o.get_object_name() in existing:
+            infos[o.get_object_name()] = get_object_info_in_database(o, ccm, relations, existing[o.get_object_name()])
+        else:
+            infos[o.get_object_name()] = None
+    return infos
+
+
+def get_relations(object_names, ccm, batch_size=50):
+    """Get predecessors and successors of many objects with a few hist commands
+
+    Returns {four-part-name: (predecessors, successors)}. hist lists the whole
+    version history of each object, so other versions are included as well."""
+    relations = {}
+    object_names = list(set(object_names))
+    for i in range(0, len(object_names), batch_size):
+        batch = object_names[i:i + batch_size]
+        try:
+            for row in ccm.hist(batch).format('%objectname').run_iter():
+                relations[row['objectname']] = (row['predecessors'], row['successors'])
+        except SynergyException:
+            logger.warning("hist of %d objects failed, querying their relations one by one", len(batch))
+            for name in batch:
+                synergy_object = SynergyObject(name, ccm.delim())
+                relations[name] = (get_predecessors(synergy_object, ccm), get_successors(synergy_object, ccm))
+    return relations
+
+def get_predecessors_and_successors(object, ccm, relations=None):
+    if relations and object.get_object_name() in relations:
+        predecessors, successors = relations[object.get_object_name()]
+        return list(predecessors), list(successors)
+    return get_predecessors(object, ccm), get_successors(object, ccm)
+
+def store_relations(relations, ccm_cache_path, exclude=()):
+    """Add the predecessors and successors of relations to the objects already in the cache
+
+    Each changed object is written once, locked, see update_cached_objects"""
+    exclude = set(exclude)
+    cached = get_metadata_store(ccm_cache_path).get_many([name for name in relations.keys() if name not in exclude])
+
+    def add_relations(object):
+        predecessors, successors = relations[object.get_object_name()]
+        new_predecessors = set(predecessors) - set(object.predecessors)
+        new_successors = set(successors) - set(object.successors)
+        if not new_predecessors and not new_successors:
+            return False
+        object.predecessors.extend(new_predecessors)
+        object.successors.extend(new_successors)
+        if new_predecessors:
+            object.validation_epoch = None
+        return True
+    changed = [name for name, object in cached.iteritems() if add_relations(object)]
+    if changed:
+        update_cached_objects(changed, ccm_cache_path, add_relations)
 
 def get_predecessors(object, ccm):
     predecessors = []
@@ -454,30 +953,66 @@ def task_to_four_part(task, delim):
     four_part = ['task', split[1], delim, '1:task:', split[0]]
     return ''.join(four_part)
 
-def get_non_blacklisted_attributes(obj, ccm):
-    attribute_blacklist = ['_archive_info', '_modify_time', 'binary_scan_file_time',
-        'cluster_id', 'comment',  'create_time', 'created_in', 'cvtype', 'dcm_receive_time',
-        'handle_source_as', 'is_asm', 'is_model', 'local_to', 'modify_time', 'name',
-        'owner', 'project', 'release', 'source_create_time', 'source_modify_time',
-        'status', 'subsystem', 'version', 'wa_type', '_relations', 'est_duration',
-        'groups' , 'platform', 'priority', 'task_subsys', 'assigner', 'assignment_date',
-        'completed_id', 'completed_in', 'completion_date', 'creator', 'modifiable_in',
-        'registration_date', 'source']
-
+ATTRIBUTE_BLACKLIST = ['_archive_info', '_modify_time', 'binary_scan_file_time',
+    'cluster_id', 'comment',  'create_time', 'created_in', 'cvtype', 'dcm_receive_time',
+    'handle_source_as', 'is_asm', 'is_model', 'local_to', 'modify_time', 'name',
+    'owner', 'project', 'release', 'source_create_time', 'source_modify_time',
+    'status', 'subsystem', 'version', 'wa_type', '_relations', 'est_duration',
+    'groups' , 'platform', 'priority', 'task_subsys', 'assigner', 'assignment_date',
+    'completed_id', 'completed_in', 'completion_date', 'creator', 'modifiable_in',
+    'registration_date', 'source']
+
+def get_attribute_names(obj, ccm):
+    """Names of the attributes of obj"""
+    attr_list = ccm.attr(obj.get_object_name()).option('-l').run().splitlines()
+    return [attr.partition(' ')[0] for attr in attr_list if attr.strip()]
+
+def get_attributes_of_objects(objects, ccm, blacklist=ATTRIBUTE_BLACKLIST, batch_size=50):
+    """Get the attributes of many objects, returns {four-part-name: {attribute: value}}
+
+    Every object lists its own attributes, objects of one type don't all have
+    the same ones. The values are then fetched as fields of formatted queries
+    over the union of the names, instead of one attr command per attribute.
+    Fields and items are delimited by separators which can't occur in a value,
+    so multi-line values like status_log come through unchanged apart from
+    surrounding whitespace."""
+    names_of = {}
+    for obj in objects:
+        names_of[obj.get_object_name()] = [n for n in get_attribute_names(obj, ccm) if n not in blacklist]
+    names = sorted(set([n for object_names in names_of.values() for n in object_names]))
+    result = dict([(name, {}) for name in names_of.keys()])
+    if not names:
+        return result
+    format = ['%objectname'] + ['%' + n for n in names]
+    try:
+        rows = ccm.query_many([object_info_query(obj) for obj in objects], format, batch_size)
+    except SynergyException:
+        logger.warning("Couldn't query the attributes of %d objects, fetching them one by one", len(objects))
+        for obj in objects:
+            result[obj.get_object_name()] = get_attributes_one_by_one(obj, ccm, blacklist)
+        return result
+    for row in rows:
+        if row['objectname'] in result:
+            result[row['objectname']] = dict([(n, row[n]) for n in names_of[row['objectname']] if row[n] != '<void>'])
+    return result
+
+def get_attributes_one_by_one(obj, ccm, blacklist=ATTRIBUTE_BLACKLIST):
+    """Get the attributes of obj with one attr command per attribute"""
     attr_list = ccm.attr(obj.get_object_name()).option('-l').run().splitlines()
     attributes = {}
     for attr in attr_list:
         attr = attr.partition(' ')[0]
-        if attr not in attribute_blacklist:
+        if attr and attr not in blacklist:
             attributes[attr] = ccm.attr(obj.get_object_name()).option('-s').option(attr).run()
     return attributes
 
+def get_non_blacklisted_attributes(obj, ccm):
+    return get_attributes_of_objects([obj], ccm)[obj.get_object_name()]
+
 def get_all_attributes(obj, ccm):
-    attr_list = ccm.attr(obj.get_object_name()).option('-l').run().splitlines()
-    attributes = {}
-    for attr in attr_list:
-        attr = attr.partition(' ')[0]
-        attributes[attr] = strip_non_ascii(ccm.attr(obj.get_object_name()).option('-s').option(attr).run())
+    attributes = get_attributes_of_objects([obj], ccm, blacklist=())[obj.get_object_name()]
+    for k, v in attributes.iteritems():
+        attributes[k] = strip_non_ascii(v)
     return attributes
 
 def strip_non_ascii(str):
@@ -485,16 +1020,17 @@ def strip_non_ascii(str):
 
 
 def load_ccm_cache_path():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
+    return get_config()['ccm_cache_path']
+
+def is_cache_configured():
+    """If this process has a configuration with a ccm cache"""
+    return has_config() and bool(get_config().get('ccm_cache_path'))
 
-    return config['ccm_cache_path']
+def load_ccm_cache_backend():
+    return get_config().get('ccm_cache_backend')
 
 def create_ccm_session_from_config():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
+    config = get_config()
 
     ccm = SynergySession(config['database'])
     return ccm
@@ -23,7 +23,7 @@ FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.    IN NO EVENT SHALL THE COPYRI
 CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 from _collections import deque
-import cPickle
+import sys
 import logging as logger
 from subprocess import Popen, PIPE
 import time
@@ -33,12 +33,17 @@ from pygraph.algorithms.accessibility import accessibility
 from pygraph.algorithms.accessibility import cut_nodes
 from SynergyObject import SynergyObject
 import ccm_cache
+from load_configuration import get_config
 import convert_history as ch
 import ccm_history_to_graphs as htg
 import re
 from users import users
 
 object_mark_lookup = {}
+# git blob id of a source -> mark of the blob already written for it
+blob_mark_lookup = {}
+# file looks at this much of the content to tell text from binary
+TYPE_DETECTION_BYTES = 1024 * 1024
 users
 
 def ccm_fast_export(releases, graphs):
@@ -592,11 +597,18 @@ def get_object(o, objects):
         if obj == o:
             return ccm_cache.get_object(obj)
 
-def decide_type(obj):
-    cache_path = ccm_cache.load_ccm_cache_path()
-    dir, filename = ccm_cache.get_path_for_object(obj.get_object_name(), cache_path)
-    command = ['file', '-i', '-b', filename]
-    result = run_command(command)
+def get_head(chunks, size):
+    """The first size bytes of chunks"""
+    head = ''
+    for chunk in chunks:
+        head += str(chunk[:size - len(head)])
+        if len(head) >= size:
+            break
+    return head
+
+def decide_type(content):
+    command = ['file', '-i', '-b', '-']
+    result = run_command(command, content)
     logger.info('Result %s' % result)
     if 'binary' in result:
         return 'binary'
@@ -605,30 +617,36 @@ def decide_type(obj):
 
 def create_blob(obj, mark):
     global object_mark_lookup
+    global blob_mark_lookup
     if object_mark_lookup.has_key(obj.get_object_name()):
         object_mark = object_mark_lookup[obj.get_object_name()]
         logger.info("Used lookup-mark: %s for: %s" % (str(object_mark), obj.get_object_name()))
         return object_mark, mark
+    content_hash = ccm_cache.get_content_hash(obj.get_object_name())
+    if content_hash in blob_mark_lookup:
+        # Same content as an object already written, share its blob
+        object_mark = blob_mark_lookup[content_hash]
+        logger.info("Used blob-mark: %s of %s for: %s" % (str(object_mark), content_hash, obj.get_object_name()))
+        object_mark_lookup[obj.get_object_name()] = object_mark
+        return object_mark, mark
     else:
         #create the blob
         next_mark = get_mark(mark)
-        blob = ['blob', 'mark :' + str(next_mark)]
         logger.info("Creating lookup-mark: %s for %s" % (str(next_mark), obj.get_object_name()))
+        # The content is written as it is in the cache, without copying it into one string
+        length, chunks = ccm_cache.open_source(obj.get_object_name())
         if skip_binary():
             # Skip for binary files
             # Types and super type in Synergy can't be trusted, figure out the type manually
-            type = decide_type(obj)
-            if type == 'ascii':
-                content = ccm_cache.get_source(obj.get_object_name())
-            else: # binary
-                content = ''
-        else:
-            content = ccm_cache.get_source(obj.get_object_name())
-        length = len(content)
-        blob.append('data '+ str(length))
-        blob.append(content)
-        print '\n'.join(blob)
+            if decide_type(get_head(chunks, TYPE_DETECTION_BYTES)) == 'binary':
+                length, chunks = 0, []
+        sys.stdout.write('blob\nmark :%d\ndata %d\n' % (next_mark, length))
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        sys.stdout.write('\n')
         object_mark_lookup[obj.get_object_name()] = next_mark
+        if content_hash:
+            blob_mark_lookup[content_hash] = next_mark
         return next_mark, next_mark
 
 def create_blob_for_empty_dir(mark):
@@ -671,25 +689,20 @@ def get_mark(mark):
 
 
 def get_master_tag():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
+    config = get_config()
     object = ccm_cache.get_object(config['master'])
     tag = object.name + object.separator + object.version
     return tag
 
 def skip_binary():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
-    return config['skip_binary_files']
+    return get_config()['skip_binary_files']
 
-def run_command(command):
-    """Execute a command"""
-    p = Popen(command, stdout=PIPE, stderr=PIPE)
+def run_command(command, input=None):
+    """Execute a command, input is written to its stdin"""
+    p = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
     # Store the result as a single string.
-    stdout, stderr = p.communicate()
+    stdout, stderr = p.communicate(input)
 
     if stderr:
         return stderr
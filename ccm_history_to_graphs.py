@@ -23,9 +23,9 @@ FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.    IN NO EVENT SHALL THE COPYRI
 CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 from _collections import deque
-import cPickle
 import pygraphviz as gv
 import ccm_cache
+from load_configuration import get_config
 import convert_history as ch
 from pygraph.classes.digraph import digraph
 from pygraph.classes.hypergraph import hypergraph
@@ -99,11 +99,7 @@ def create_graphs(release):
     return object_graph, task_graph, release_graph, commit_graph
 
 def print_graphs():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
-
-    return config['print_graphs']
+    return get_config()['print_graphs']
 
 def create_release_graph(objects, release, previous):
     release_graph = hypergraph()
@@ -36,25 +36,32 @@ LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
 OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import sys
 import Queue
 from SynergySession import SynergySession, SynergyException
+from AsyncSynergySession import AsyncSynergySession
 from SynergyObject import SynergyObject
 from collections import deque
 import logging
-from multiprocessing import Pool, Manager, Process
 import time
 import ccm_cache
 
 logger = logging.getLogger("objects in project")
 
+# Times a failed member query is run again before the walk gives up
+MEMBER_QUERY_RETRIES = 2
+
 def get_objects_in_project(project, ccm=None, database=None, ccmpool=None, use_cache=False):
     """ Get all objects and paths in project
         If use_cache is enabled all objects will stored in cache area
     """
     start = time.time()
-    if ccmpool:
-        if ccmpool.nr_sessions == 1:
-            result = get_objects_in_project_serial(project, ccm=ccmpool[0], database=database, use_cache=use_cache)
+    if isinstance(ccm, AsyncSynergySession) and not use_cache:
+        result = get_objects_in_project_async(project, ccm)
+    elif ccmpool:
+        if ccmpool.max_sessions == 1:
+            with ccmpool.lease() as pool_ccm:
+                result = get_objects_in_project_serial(project, ccm=pool_ccm, database=database, use_cache=use_cache)
         else:
             result = get_objects_in_project_parallel(project, ccmpool=ccmpool, use_cache=use_cache)
     else:
@@ -107,11 +114,13 @@ def get_objects_in_project_serial(project, ccm=None, database=None, use_cache=Fa
         if use_cache:
             objects = []
             na_obj = []
+            result = list(result)
+            cached = ccm_cache.get_objects([item['objectname'] for item in result], ccm)
             for item in result:
-                try:
-                    objects.append(ccm_cache.get_object(item['objectname'], ccm))
-                except ccm_cache.ObjectCacheException:
-                    objects.append(SynergyObject(item['objectname'], ccm.delim()))
+                if item['objectname'] in cached:
+                    objects.append(cached[item['objectname']])
+                else:
+                    objects.append(SynergyObject(item['objectname'], delim))
                     na_obj.append(item['objectname'])
             if na_obj:
                 logger.warning("Objects not avaliable in this db:")
@@ -190,34 +199,76 @@ def find_root_project(project, objects, ccm):
 
 def get_members(obj, ccm, parent_proj):
     """ Get directory members of a project
-    Get all members of a directory object """
+    Get all members of a directory object
+    The members are returned as an iterator, parsed while ccm is running """
+    return members_query(obj, ccm, parent_proj).run_iter()
+
+
+def members_query(obj, ccm, parent_proj):
+    """ Set up the query for the members of obj on ccm, ready to be run """
     if obj.get_type() == 'dir':
-        objects = ccm.query("is_child_of('{0}', '{1}')".format(
-            obj.get_object_name(), parent_proj)).format('%objectname').run()
-    else:
-        # For projects only get the directory of the project
-        objects = ccm.query(
-            "is_member_of('{0}') and type='dir' and name='{1}'".format(
-                obj.get_object_name(), obj.get_name())).format(
-                    '%objectname').run()
-    return objects
+        return ccm.query("is_child_of('{0}', '{1}')".format(
+            obj.get_object_name(), parent_proj)).format('%objectname')
+    # For projects only get the directory of the project
+    return ccm.query(
+        "is_member_of('{0}') and type='dir' and name='{1}'".format(
+            obj.get_object_name(), obj.get_name())).format('%objectname')
+
+
+def get_objects_in_project_async(project, ccm):
+    """ Get all objects and paths of a project, keeping the member queries of
+    all known directories and projects in flight at once on the sessions of
+    the pool of an AsyncSynergySession """
+    delim = ccm.delim()
+    start_object = SynergyObject(project, delim)
+    hierarchy = {start_object.get_object_name(): [start_object.name]}
+    dir_structure = {start_object.get_object_name(): ''}
+    proj_lookup = {}
 
+    done_queue = Queue.Queue()
 
-def do_query(next_in_queue, free_ccm, semaphore, delim, p_queue, use_cache):
-    (project, parent_proj) = next_in_queue
-    ccm_addr, database = get_and_lock_free_ccm_addr(free_ccm)
-    ccm = SynergySession(database, ccm_addr=ccm_addr)
-    ccm.keep_session_alive = True
+    def submit(synergy_object):
+        parent_proj = None
+        if synergy_object.get_type() == 'dir':
+            parent_proj = proj_lookup[synergy_object.get_object_name()]
+        return members_query(synergy_object, ccm, parent_proj).run_async(done_queue)
+
+    pending = {}
+    next_on_queue = [start_object]
+    while next_on_queue or pending:
+        # Start queries for everything found so far
+        for synergy_object in next_on_queue:
+            pending[submit(synergy_object)] = (synergy_object, 0)
+        # Handle the next query to finish, failed ones are retried like in the parallel walk
+        obj, result = wait_for_members(done_queue, pending, submit)
+        objects = [SynergyObject(item['objectname'], delim)
+                   for item in result]
+        # if a project is being queried it might have more than one dir with
+        # the same name as the project associated, find the directory that has
+        # the project associated as the directory's parent
+        if obj.get_type() == 'project':
+            if len(objects) > 1:
+                objects = find_root_project(obj, objects, ccm)
+        next_on_queue, hierarchy, dir_structure, proj_lookup = \
+        do_results((obj, objects), hierarchy, dir_structure, proj_lookup)
+        logger.debug("Objects %6d ... in flight %6d" % (len(hierarchy),
+                                                        len(pending)))
+    return hierarchy
+
+
+def get_member_objects(ccm, project, parent_proj, delim, use_cache):
 #    logger.debug('Querying: %s' % project.get_object_name())
 
     result = get_members(project, ccm, parent_proj)
     if use_cache:
         objects = []
         na_obj = []
+        result = list(result)
+        cached = ccm_cache.get_objects([item['objectname'] for item in result], ccm)
         for item in result:
-            try:
-                objects.append(ccm_cache.get_object(item['objectname'], ccm))
-            except ccm_cache.ObjectCacheException:
+            if item['objectname'] in cached:
+                objects.append(cached[item['objectname']])
+            else:
                 objects.append(SynergyObject(item['objectname'], delim))
                 na_obj.append(item['objectname'])
         if na_obj:
@@ -234,11 +285,7 @@ def do_query(next_in_queue, free_ccm, semaphore, delim, p_queue, use_cache):
         if len(objects) > 1:
             objects = find_root_project(project, objects, ccm)
 
-    p_queue.put((project, objects))
-    entry = free_ccm[ccm_addr]
-    entry['free'] = True
-    free_ccm[ccm_addr] = entry
-    semaphore.release()
+    return objects
 
 
 def do_results(from_queue, hierarchy, dir_structure, proj_lookup):
@@ -302,150 +349,70 @@ def do_results(from_queue, hierarchy, dir_structure, proj_lookup):
     return next_on_queue, hierarchy, dir_structure, proj_lookup
 
 
-def get_and_lock_free_ccm_addr(free_ccm):
-    """ Get a free ccm session and mark it as being in use """
-    for k in free_ccm.keys():
-        entry = free_ccm[k]
-        if free_ccm[k]['free']:
-            # Extract dict entry and write it back to dict to inform manager
-            # of update
-            entry['free'] = False
-            free_ccm[k] = entry
-            return k, free_ccm[k]['database']
-
-
 def get_objects_in_project_parallel(project, ccmpool=None, use_cache=False):
     """ Get all the objects and paths of project with use of multiple ccm
-    sessions """
-    mgr = Manager()
-    free_ccm = mgr.dict()
-
-    for ccm in ccmpool.sessionArray.values():
-        free_ccm[ccm.getCCM_ADDR()] = {'free': True, 'database': ccm.database}
-    ccm_addr, database = get_and_lock_free_ccm_addr(free_ccm)
-    ccm = SynergySession(database, ccm_addr=ccm_addr)
-    ccm.keep_session_alive = True
-    delim = ccm.delim()
-
-    semaphore = mgr.Semaphore(ccmpool.nr_sessions)
-
-    # Starting project
-    if use_cache:
-        start_object = ccm_cache.get_object(project, ccm)
-    else:
-        start_object = SynergyObject(project, delim)
+    sessions, the queries run on the threads of ccmpool """
+    with ccmpool.lease() as ccm:
+        delim = ccm.delim()
 
-    # unlock update dict entry to inform manager
-    entry = free_ccm[ccm_addr]
-    entry['free'] = True
-    free_ccm[ccm_addr] = entry
-
-    p_queue = mgr.Queue()
-    c_queue = mgr.Queue()
-    c_queue.put((start_object, None))
-    p_queue.put(start_object)
-
-    # start the produce and consumer thread
-    prod = Process(target=producer, args=(c_queue, p_queue, free_ccm))
-    cons = Process(target=consumer, args=(c_queue, p_queue, free_ccm,
-                                          semaphore, delim, use_cache))
+        # Starting project
+        if use_cache:
+            start_object = ccm_cache.get_object(project, ccm)
+        else:
+            start_object = SynergyObject(project, delim)
 
-    prod.start()
-    cons.start()
-    logger.debug("Waiting to join")
-    cons.join()
-    hierarchy = p_queue.get()
-    prod.join()
+    hierarchy = {start_object.get_object_name(): [start_object.name]}
+    dir_structure = {start_object.get_object_name(): ''}
+    proj_lookup = {}
+    done_queue = Queue.Queue()
 
+    def submit(synergy_object):
+        parent_proj = None
+        if synergy_object.get_type() == 'dir':
+            parent_proj = proj_lookup[synergy_object.get_object_name()]
+        return ccmpool.submit(get_member_objects, synergy_object, parent_proj, delim, use_cache, done_queue=done_queue)
+
+    pending = {}
+    next_on_queue = [start_object]
+    while next_on_queue or pending:
+        for synergy_object in next_on_queue:
+            pending[submit(synergy_object)] = (synergy_object, 0)
+        # Handle the next query to finish
+        obj, objects = wait_for_members(done_queue, pending, submit)
+        next_on_queue, hierarchy, dir_structure, proj_lookup = \
+        do_results((obj, objects), hierarchy, dir_structure, proj_lookup)
+        logger.debug("Objects %6d ... in flight %6d" % (len(hierarchy),
+                                                        len(pending)))
     return hierarchy
 
 
-def consumer(c_queue, p_queue, free_ccm, semaphore, delim, use_cache):
-    """ This thread handles queries to the ccm sessions by allpying them
-    async to a process pool """
-    done = False
-    pool = Pool(len(free_ccm.keys()))
-
-    while not done:
-        #get item from queue
-        #logger.debug("Object count ------ ... P queue length %6d ... C queue
-        # length %6d" % (p_queue.qsize(), c_queue.qsize()))
-        next_in_queue = c_queue.get()
-        if next_in_queue == "DONE":
-            #done = True
-            break
-
-        semaphore.acquire()
-        pool.apply_async(do_query,
-                         (next_in_queue, free_ccm, semaphore, delim, p_queue, use_cache))
+def wait_for_members(done_queue, pending, submit):
+    """ Wait for the next of the member queries in flight to finish, returns
+    (object, members)
 
-    pool.close()
-    pool.join()
-
-
-def producer(c_queue, p_queue, free_ccm):
-    """ Handle the query results from synergy and put new projects / dirs on
-    the queue to be handled """
-    project_hierarchy = {}
-    dir_structure = {}
-    proj_lookup = {}
-
-    start_project = p_queue.get()
-    dir_structure[start_project.get_object_name()] = ''
-    project_hierarchy[start_project.get_object_name()] = [start_project.name]
-    done = False
-    while not done or p_queue.qsize() > 0:
-        # check if all ccm's are free for 5 seconds if they are it's all done
-        #if not p_queue.qsize():
-        done = True
-        for i in range(10):
-            if [free_ccm[k]['free'] for k in free_ccm.keys() if
-                free_ccm[k]['free'] == False]:
-                done = False
-                logger.debug("ccm busy...")
-                break
-            else:
-                logger.debug("sleep...")
-                if p_queue.qsize() > 0:
-                    done = False
-                    break
-                time.sleep(0.1)
-
-        if done:
-            break
-#        logger.debug("Thread: %s ", multiprocessing.current_process().name)
-
-        # Get results from ccm query and put new objects on the queue
+    pending is {future: (object, tries)} of the queries in flight. A query
+    failing with a SynergyException is run again with submit(object), up to
+    MEMBER_QUERY_RETRIES times. When it fails for good the queries still in
+    flight are waited for and the error is raised, so a walk never takes a
+    failed directory for an empty one """
+    while True:
+        future = done_queue.get()
+        obj, tries = pending.pop(future)
         try:
-            next_in_queue = p_queue.get(timeout=1200) # 1200 secs,
-            # to allow ccm_cache to populate if option is chosen
-        except Queue.Empty:
-            logger.warning("Synergy timeout")
-            logger.debug("Free ccm: %s ",
-                         [k['free'] for k in free_ccm.values()] )
-            for k in free_ccm.keys():
-                entry = free_ccm[k]
-                if free_ccm[k]['free']:
-                    entry['free'] = True
-                    free_ccm[k] = entry
-            break
-        (objects, project_hierarchy, dir_structure, proj_lookup) = \
-        do_results(next_in_queue, project_hierarchy, dir_structure, proj_lookup)
-
-        # put on queue
-        for synergy_object in objects:
-            parent_proj = None
-            if synergy_object.get_type() == 'dir':
-                parent_proj = proj_lookup[synergy_object.get_object_name()]
-            c_queue.put((synergy_object, parent_proj))
-
-        logger.debug("Objects %6d ... P queue %6d ... C queue %6d" % (
-        len(project_hierarchy.keys()), p_queue.qsize(), c_queue.qsize()))
-
-    logger.debug("we're done...")
-    if done:
-        c_queue.put("DONE")
-    p_queue.put(project_hierarchy)
+            return obj, future.result()
+        except SynergyException, e:
+            if tries < MEMBER_QUERY_RETRIES:
+                logger.warning("Couldn't get the members of %s, trying again: %s" % (obj.get_object_name(), e))
+                pending[submit(obj)] = (obj, tries + 1)
+                continue
+            logger.error("Couldn't get the members of %s: %s" % (obj.get_object_name(), e))
+            error = sys.exc_info()
+        except Exception:
+            error = sys.exc_info()
+        # The queries in flight belong to this walk, don't leave them running behind it
+        while pending:
+            pending.pop(done_queue.get())
+        raise error[0], error[1], error[2]
 
 
 def main():
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ccm_run.py
+
+Set up and wind down a run of one of the scripts working on Synergy, so
+they share the same configuration of the sessions and the caches and write
+the same metrics.
+
+    start_run(config)       before the first session is started
+    finish_run(config)      when the work is done, commits the caches and writes the report
+"""
+
+import logging as logger
+
+import ccm_cache
+from EngineLimiter import get_limiter_metrics
+from CommandMemo import get_command_memo
+from Cassette import configure_cassette
+from SessionRegistry import configure_session_registry
+from ObjectCache import configure_object_cache, get_object_cache
+from CommandStats import start_command_stats, write_command_stats_report
+
+
+def start_run(config):
+    """Configure the cassette, the session registry and the object cache, and load the command memo"""
+    configure_cassette(config)
+    configure_session_registry(config)
+    configure_object_cache(config)
+    start_command_stats()
+    if config.get('ccm_memo_file'):
+        get_command_memo().load(config['ccm_memo_file'])
+
+def get_run_metrics():
+    """The metrics of the caches and limiters of this process, by name"""
+    return {'rate_limiter': get_limiter_metrics(),
+            'command_memo': get_command_memo().get_metrics(),
+            'object_cache': get_object_cache().get_metrics(),
+            'negative_cache': ccm_cache.get_negative_cache().get_metrics(),
+            'object_locks': ccm_cache.get_object_locks().get_metrics()}
+
+def finish_run(config):
+    """Commit the caches, save the command memo, log the metrics and write the ccm command statistics
+
+    Returns the report written, see write_command_stats_report"""
+    ccm_cache.flush_metadata_stores()
+    if config.get('ccm_memo_file'):
+        get_command_memo().save(config['ccm_memo_file'])
+    metrics = get_run_metrics()
+    for name, values in sorted(metrics.iteritems()):
+        logger.info("%s metrics: %s" % (name.replace('_', ' '), str(values)))
+    return write_command_stats_report(config.get('ccm_stats_report') or 'ccm_stats.json', metrics)
@@ -32,39 +32,35 @@ from SynergyObject import SynergyObject
 def get_types_and_permissions(ccm):
     type_dict = {}
 
-    types = get_all_types(ccm)
-
-    # Map each type to permission
-    for t in types:
-        lines = ccm.attr(t.get_object_name()).option("-s").option("file_acs").run().splitlines()
-        for line in lines:
+    # Map each type to permission, the file_acs attribute of all types comes with one query
+    for t in get_type_attribute(ccm, "file_acs"):
+        for line in t["file_acs"].splitlines():
             if line.startswith("working"):
                 mode = line.split(":")[-1]
-                type_dict[t.get_name()] = '10' + mode.strip()
+                type_dict[t["name"]] = '10' + mode.strip()
                 break
     return type_dict
 
+def get_type_attribute(ccm, attribute):
+    """Get the name and the value of attribute of all types, types without the attribute are left out"""
+    result = ccm.query("type='attype'").format("%name").format("%" + attribute).run()
+    return [t for t in result if t[attribute] != '<void>']
+
 def get_all_types(ccm):
     delim = ccm.delim()
 
       # Query for all types
-    result = ccm.query("type='attype'").format("%name").format("%version").format("%type").format("%instance").run()
+    result = ccm.query("type='attype'").format("%name").format("%version").format("%type").format("%instance").run_iter()
     types = [SynergyObject(t["name"] + delim + t["version"] + ":" + t["type"] + ":" + t["instance"], delim) for t in result]
 
     return types
 
 def get_super_types(ccm):
     type_dict = {}
-    types = get_all_types(ccm)
-
-    # Map each type to permission
-    for t in types:
-        line = ccm.attr(t.get_object_name()).option("-s").option("super_type").run().strip()
-        if 'Attribute \'super_type\'' in line:
-            # just skip
-            continue
-        else:
-            type_dict[t.get_name()] = line
+
+    # Map each type to its super type
+    for t in get_type_attribute(ccm, "super_type"):
+        type_dict[t["name"]] = t["super_type"]
 
     return type_dict
 
@@ -23,12 +23,17 @@ FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.    IN NO EVENT SHALL THE COPYRI
 CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import sys
 import cPickle
 import ccm_history_to_graphs as cg
 import ccm_fast_export as cfe
 from load_configuration import load_config_file
+from ccm_run import start_run, finish_run
 
-data_file = load_config_file()['data_file']
+config = load_config_file()
+# Objects missing in the cache are fetched from Synergy, or from the cassette
+start_run(config)
+data_file = config['data_file']
 data_file += '.p'
 f = open(data_file, 'rb')
 history = cPickle.load(f)
@@ -38,4 +43,7 @@ cgraphs = cg.create_graphs_from_releases(history)
 
 cfe.ccm_fast_export(history, cgraphs)
 
-
+report = finish_run(config)
+# stdout carries the fast-import stream
+print >> sys.stderr, "ccm commands: %s" % str(report['total'])
+print >> sys.stderr, "object cache metrics: %s" % str(report['object_cache'])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fake_ccm.py
+
+Stand-in for the ccm command line client, answering commands with synthetic
+data so the session layer can be exercised without a Synergy server.
+
+    fake_ccm.py <ccm command and arguments>   behave like ccm
+    fake_ccm.py channel                       serve a CommandChannel
+    fake_ccm.py bench [count]                 measure SynergySession throughput
+
+The environment variables FAKE_CCM_ROWS (rows returned by relation queries
+and files per directory, default 3), FAKE_CCM_DEPTH (depth of the directory
+tree of every project, default 2) and FAKE_CCM_LATENCY (seconds of simulated
+engine time per command, default 0) tune the responses.
+"""
+
+import os
+import re
+import sys
+import time
+
+import CommandChannel
+
+ROWS = int(os.environ.get('FAKE_CCM_ROWS', 3))
+LATENCY = float(os.environ.get('FAKE_CCM_LATENCY', 0))
+DEPTH = int(os.environ.get('FAKE_CCM_DEPTH', 2))
+
+CREATE_TIME = 'Mon Jan 03 10:00:00 2011'
+HIST_SEPARATOR = '*****************************************************************************'
+
+
+def handle(args):
+    """Answer one ccm command, returns (returncode, stdout, stderr)"""
+    if LATENCY:
+        time.sleep(LATENCY)
+    if not args:
+        return 1, '', 'Usage: ccm <command>\n'
+
+    command = args[0]
+    if command == 'start':
+        return 0, 'localhost:%d:127.0.0.1' % os.getpid(), ''
+    if command == 'stop':
+        return 0, '', ''
+    if command == 'delim':
+        return 0, '-\n', ''
+    if command in ('query', 'task', 'rp'):
+        return 0, ''.join([format_object(get_format(args), o) for o in get_objects(args[-1])]), ''
+    if command == 'hist':
+        return 0, hist(args), ''
+    if command == 'attr':
+        return 0, attr(args), ''
+    if command == 'cat':
+        return 0, 'Content of %s\n' % args[1], ''
+    if command == 'finduse':
+        return 0, '%s\n\tfake/%s@fake-1:project:1\n' % (args[1], args[1]), ''
+    if command == 'diff':
+        return 0, '', ''
+    return 1, '', 'Unknown command: %s\n' % command
+
+
+def get_format(args):
+    if '-f' in args:
+        return args[args.index('-f') + 1]
+    return '%objectname'
+
+
+def get_objects(query):
+    """The objects matching query, as (name, version, type, instance) tuples"""
+    matches = re.findall("name='(.*?)' and version='(.*?)' and type='(.*?)' and instance='(.*?)'", query)
+    if matches:
+        return matches
+    m = re.search("is_member_of\('.*?'\) and type='dir' and name='(.*?)'", query)
+    if m:
+        # The root directory of a project
+        return [(m.group(1), '1', 'dir', '1')]
+    m = re.search("is_child_of\('(.*?)-\d+:dir:\d+'", query)
+    if m:
+        # A few files and, down to a depth of FAKE_CCM_DEPTH, two sub directories in every directory
+        parent = m.group(1)
+        children = [('%s_f%d.c' % (parent, i), '1', 'ascii', '1') for i in range(ROWS)]
+        if parent.count('_d') < DEPTH:
+            children.extend([('%s_d%d' % (parent, i), '1', 'dir', '1') for i in range(2)])
+        return children
+    return [('fake%d.c' % i, '1', 'ascii', '1') for i in range(ROWS)]
+
+
+def format_object(format, obj):
+    name, version, type, instance = obj
+    fields = {'objectname': '%s-%s:%s:%s' % obj,
+              'name': name,
+              'version': version,
+              'type': type,
+              'instance': instance,
+              'owner': 'fakeuser',
+              'status': 'integrate',
+              'create_time': CREATE_TIME,
+              'task': '<void>',
+              'status_log': "%s: Status set to 'integrate' by fakeuser in role build_mgr" % CREATE_TIME,
+              'task_description': 'First line of %s\nSecond line' % name,
+              'file_acs': 'working: 644\nintegrate: 444'}
+    return re.sub('%(\w+)', lambda m: fields.get(m.group(1), '<void>'), format)
+
+
+def hist(args):
+    """Every object has the versions 1 up to its own version, in one line of descent"""
+    format = get_format(args)
+    names = args[args.index('-f') + 2:]
+    out = []
+    for name in names:
+        m = re.match('(.+)-(\d+):(.+):(.+)$', name)
+        if not m:
+            continue
+        base, version, type, instance = m.groups()
+        for v in range(1, int(version) + 1):
+            predecessors = ''
+            successors = ''
+            if v > 1:
+                predecessors = '\t%s-%d:%s:%s\n' % (base, v - 1, type, instance)
+            if v < int(version):
+                successors = '\t%s-%d:%s:%s\n' % (base, v + 1, type, instance)
+            out.append('%s\nPredecessors:\n%sSuccessors:\n%s%s\n' % (format_object(format, (base, str(v), type, instance)),
+                                                                   predecessors, successors, HIST_SEPARATOR))
+    return ''.join(out)
+
+
+def attr(args):
+    if '-l' in args:
+        return 'status_log (text)\ncomment (text)\ntask_description (text)\n'
+    name = args[args.index('-s') + 1]
+    if name == 'status_log':
+        return "%s: Status set to 'integrate' by fakeuser in role build_mgr\n" % CREATE_TIME
+    return 'Value of %s\n' % name
+
+
+def bench(command, count):
+    from SynergySession import SynergySession
+
+    for label, channel in (('one process per command', None), ('command channel', [command, 'channel'])):
+        ccm = SynergySession('fakedb', command_name=command, channel=channel)
+        start = time.time()
+        for i in range(count):
+            ccm.query("is_predecessor_of('fake.c-%d:ascii:1')" % i).format('%objectname').run()
+        elapsed = time.time() - start
+        print "%-25s %6d commands in %7.2f s (%8.1f commands/s)" % (label, count, elapsed, count / elapsed)
+        ccm.stop()
+        ccm.keep_session_alive = True
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'channel':
+        CommandChannel.serve(handle)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        count = 500
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        bench(os.path.abspath(sys.argv[0]), count)
+    else:
+        returncode, stdout, stderr = handle(sys.argv[1:])
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        sys.exit(returncode)
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ Copyright (c) 2011 Aske Olsson. All rights reserved.
 """
 
 from ccm_objects_in_project import get_objects_in_project
+import ccm_cache
 import os
 
 def get_snapshot(project, ccm, outdir):
@@ -22,7 +23,7 @@ def get_snapshot(project, ccm, outdir):
     for object, paths in objects.iteritems():
 #        print object, paths
         if not ':dir:' in object and not ':project:' in object:
-            content = ccm.cat(object).run()
+            chunks = open_source(object, ccm)
             for path in paths:
                 p = outdir + path
                 dir = os.path.split(p)[0]
@@ -30,13 +31,26 @@ def get_snapshot(project, ccm, outdir):
                     os.makedirs(dir)
                 print "Writing %s to %s" %(object, p)
                 f = open(p, 'wb')
-                f.write(content)
+                for chunk in chunks:
+                    f.write(chunk)
                 f.close()
 
     # handle empty dirs by adding .gitignore to empty leaf dirs
     empty_dirs = get_empty_dirs(objects)
     write_empty_dirs(empty_dirs, outdir)
 
+def open_source(object, ccm):
+    """The source of object as chunks to write one after the other
+
+    From the ccm cache, memory mapped where possible, if one is configured
+    and has the source, else from ccm cat"""
+    if ccm_cache.is_cache_configured():
+        try:
+            return ccm_cache.open_object_source_from_cache(object, ccm_cache.load_ccm_cache_path())[1]
+        except ccm_cache.ObjectCacheException:
+            pass
+    return [ccm.cat(object).run()]
+
 def write_empty_dirs(dirs, outdir):
     for dir in dirs:
         path = os.path.join(outdir, dir)
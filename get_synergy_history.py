@@ -28,12 +28,21 @@ import logging as logger
 
 from SynergySession import SynergySession
 from SynergySessions import SynergySessions
+from AsyncSynergySession import AsyncSynergySessions
 from CCMHistory import CCMHistory
 from load_configuration import load_config_file
+from ccm_run import start_run, finish_run
 
 def start_sessions(config):
-    ccm = SynergySession(config['database'], offline=config['offline'])
-    ccm_pool = SynergySessions(database=config['database'], nr_sessions=config['max_sessions'], offline=config['offline'])
+    start_run(config)
+    channel = config.get('ccm_channel')
+    if config.get('max_in_flight'):
+        # The member queries are kept in flight on the sessions of the pool, which also serves the prefetch
+        ccm_pool = AsyncSynergySessions(database=config['database'], nr_sessions=1, offline=config['offline'], channel=channel,
+                                        max_in_flight=config['max_in_flight'], max_sessions=config['max_sessions'])
+        return ccm_pool.session(), ccm_pool
+    ccm = SynergySession(config['database'], offline=config['offline'], channel=channel)
+    ccm_pool = SynergySessions(database=config['database'], nr_sessions=1, max_sessions=config['max_sessions'], offline=config['offline'], channel=channel)
 
     return ccm, ccm_pool
 
@@ -83,11 +92,15 @@ def main():
     if config.has_key('heads'):
         for head in config['heads']:
             history = ccm_hist.get_project_history(head, config['base_project'])
-        
+    if ccm_pool:
+        ccm_pool.close()
+
     fh = open(config['data_file'] + '.p', 'wb')
     cPickle.dump(history, fh, cPickle.HIGHEST_PROTOCOL)
     fh.close()
 
+    finish_run(config)
+
     logger.shutdown()
 if __name__ == '__main__':
     main()
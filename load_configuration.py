@@ -24,13 +24,38 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 """
 from ConfigParser import ConfigParser
 import cPickle
+import shlex
+import os
 
 
+# The configuration of this process, see get_config
+_config = None
+
 def save_config(config):
     f = open('config.p', 'wb')
     cPickle.dump(config, f)
     f.close()
 
+def get_config():
+    """The configuration of this process
+
+    Set by load_config_file, or loaded from config.p by the first call in a
+    process which didn't read configuration.conf"""
+    global _config
+    if _config is None:
+        f = open('config.p', 'rb')
+        _config = cPickle.load(f)
+        f.close()
+    return _config
+
+def has_config():
+    """If get_config has a configuration to return, set or saved in config.p"""
+    return _config is not None or os.path.isfile('config.p')
+
+def set_config(config):
+    global _config
+    _config = config
+
 def load_config_file():
 
     config_parser = ConfigParser()
@@ -43,13 +68,29 @@ def load_config_file():
             v = int(v)
         if k == 'max_recursion_depth':
             v = int(v)
+        if k == 'max_in_flight':
+            v = v and int(v)
+        if k == 'ccm_session_max_idle':
+            v = v and int(v)
+        if k == 'ccm_object_cache_size':
+            v = v and int(v)
+        if k == 'ccm_negative_ttl':
+            v = v and int(v)
+        if k == 'ccm_negative_failed_ttl':
+            v = v and int(v)
         if k == 'heads':
             v = v.split(',')
             v = [i.strip() for i in v]
+        if k == 'merge_databases':
+            v = [i.strip() for i in v.split(',') if i.strip()]
         if k == 'skip_binary_files':
             v = config_parser.getboolean('synergy', 'skip_binary_files')
         if k == 'offline':
             v = config_parser.getboolean('synergy', 'offline')
+        if k == 'ccm_cassette_latency':
+            v = config_parser.getboolean('synergy', 'ccm_cassette_latency')
+        if k == 'ccm_channel':
+            v = shlex.split(v)
         config[k]=v
     for k, v in config_parser.items('history conversion'):
         if k == 'print_graphs':
@@ -68,5 +109,6 @@ def load_config_file():
             config['heads'].remove(config['master'])
 
     save_config(config)
+    set_config(config)
 
     return config
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+migrate_ccm_cache.py
+
+Copy the meta data of the ccm cache from the per object pickle files into
+the SQLite store, see MetadataStore.py, or move the sources of a cache from
+before the blob store into it, see BlobStore.py.
+
+    migrate_ccm_cache.py [--delete]
+    migrate_ccm_cache.py --blobs
+    migrate_ccm_cache.py --reencode [processes]
+
+Reads ccm_cache_path from configuration.conf. With --delete the _data
+pickles are removed once all objects are committed to the database. Set
+ccm_cache_backend=sqlite in configuration.conf afterwards.
+
+--blobs works on the store ccm_cache_backend selects, the source files are
+removed once their objects reference the blob.
+
+--reencode rewrites the objects of that store which aren't in the current
+ObjectCodec encoding yet, on several processes at once.
+"""
+
+import os
+import sys
+import time
+import logging as logger
+from multiprocessing import Pool, cpu_count
+
+from load_configuration import load_config_file
+from MetadataStore import FileMetadataStore, SqliteMetadataStore, SQLITE_FILENAME, create_metadata_store
+from BlobStore import BlobStore, BLOBS_DIR
+from ObjectCodec import encode, decode, is_encoded
+import ccm_cache
+
+
+def migrate(ccm_cache_path, batch_size=1000, delete=False):
+    """Copy all objects of the file store into the SQLite store, returns the number of objects"""
+    files = FileMetadataStore(ccm_cache_path)
+    sqlite = SqliteMetadataStore(os.path.join(ccm_cache_path, SQLITE_FILENAME), batch_size)
+    start = time.time()
+    count = 0
+    for object in files.iter_objects():
+        sqlite.put(object)
+        count += 1
+        if count % batch_size == 0:
+            logger.info("Migrated %d objects, %.0f objects/s" % (count, count / (time.time() - start)))
+    sqlite.flush()
+    logger.info("Migrated %d objects in %.1f s" % (count, time.time() - start))
+
+    if delete:
+        for dir in os.listdir(ccm_cache_path):
+            path = os.path.join(ccm_cache_path, dir)
+            if len(dir) != 2 or not os.path.isdir(path):
+                continue
+            for filename in os.listdir(path):
+                if filename.endswith('_data'):
+                    os.remove(os.path.join(path, filename))
+                    # The index of the file store is keyed by the start of the sha the file is named after
+                    files.index.discard(dir + filename[:-len('_data')])
+        files.save_index()
+    return count
+
+def migrate_blobs(ccm_cache_path, backend):
+    """Move the source files into the blob store, returns the number of objects moved"""
+    store = create_metadata_store(backend, ccm_cache_path)
+    blobs = BlobStore(os.path.join(ccm_cache_path, BLOBS_DIR))
+    moved = []
+    for object in store.iter_objects():
+        if getattr(object, 'content_hash', None):
+            continue
+        filename = ccm_cache.get_path_for_object(object.get_object_name(), ccm_cache_path)[1]
+        if not os.path.exists(filename):
+            continue
+        f = open(filename, 'rb')
+        object.content_hash = blobs.put(f.read())
+        f.close()
+        store.put(object)
+        moved.append(filename)
+    store.flush()
+    store.save_index()
+    blobs.save_index()
+    # Only now all objects reference their blob
+    for filename in moved:
+        os.remove(filename)
+    logger.info("Moved the sources of %d objects into %s" % (len(moved), blobs.path))
+    return len(moved)
+
+def reencode(ccm_cache_path, backend, processes=None):
+    """Rewrite the objects not in the current encoding, returns the number of objects rewritten"""
+    pool = Pool(processes or cpu_count())
+    start = time.time()
+    count = 0
+    store = create_metadata_store(backend, ccm_cache_path)
+    if isinstance(store, SqliteMetadataStore):
+        # The processes encode, this one reads and writes the database
+        for rows in pool.imap(reencode_rows, store.iter_raw()):
+            if rows:
+                store.put_raw(rows)
+                count += len(rows)
+                logger.info("Re-encoded %d objects, %.0f objects/s" % (count, count / (time.time() - start)))
+    else:
+        dirs = [os.path.join(ccm_cache_path, dir) for dir in sorted(os.listdir(ccm_cache_path)) if len(dir) == 2]
+        for done in pool.imap_unordered(reencode_dir, [dir for dir in dirs if os.path.isdir(dir)]):
+            count += done
+            logger.info("Re-encoded %d objects, %.0f objects/s" % (count, count / (time.time() - start)))
+    pool.close()
+    pool.join()
+    logger.info("Re-encoded %d objects in %.1f s" % (count, time.time() - start))
+    return count
+
+def reencode_rows(rows):
+    """The rows, (name, data), which need re-encoding, re-encoded"""
+    return [(name, encode(decode(data))) for name, data in rows if not is_encoded(data)]
+
+def reencode_dir(dir):
+    """Re-encode the _data files of dir, returns the number of files rewritten"""
+    count = 0
+    for filename in os.listdir(dir):
+        if not filename.endswith('_data'):
+            continue
+        filename = os.path.join(dir, filename)
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        if is_encoded(data):
+            continue
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmp, 'wb')
+        f.write(encode(decode(data)))
+        f.close()
+        os.rename(tmp, filename)
+        count += 1
+    return count
+
+def main():
+    logger.basicConfig(level=logger.INFO)
+    config = load_config_file()
+    if '--reencode' in sys.argv[1:]:
+        args = sys.argv[sys.argv.index('--reencode') + 1:]
+        count = reencode(config['ccm_cache_path'], config.get('ccm_cache_backend'), args and int(args[0]) or None)
+        print "Re-encoded %d objects" % count
+        return
+    if '--blobs' in sys.argv[1:]:
+        count = migrate_blobs(config['ccm_cache_path'], config.get('ccm_cache_backend'))
+        print "Moved the sources of %d objects into the blob store" % count
+        return
+    count = migrate(config['ccm_cache_path'], delete='--delete' in sys.argv[1:])
+    print "Migrated %d objects to %s" % (count, os.path.join(config['ccm_cache_path'], SQLITE_FILENAME))
+    if config.get('ccm_cache_backend') != 'sqlite':
+        print "Set ccm_cache_backend=sqlite in configuration.conf to use it"
+
+if __name__ == '__main__':
+    main()
@@ -23,9 +23,11 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 from CCMHistory import get_project_chain
 from SynergySession import SynergySession
 from SynergySessions import SynergySessions
+from SynergyDatabases import SynergyDatabases
 import ccm_cache
 import ccm_objects_in_project
 from load_configuration import load_config_file
+from ccm_run import start_run, finish_run
 import logging as logger
 
 
@@ -55,6 +57,24 @@ def populate_cache_with_projects(config):
     for project in sorted(set(projects)):
         populate_cache_with_objects_from_project(project, ccm, ccmpool)
 #        update_project_with_members(project, ccm, ccmpool)
+    ccmpool.close()
+
+    # Link all the objects with their predecessors now, instead of on their first read
+    for project in sorted(set(projects)):
+        project_obj = ccm_cache.get_object(project, ccm)
+        ccm_cache.validate_cache(ccm, [project] + (project_obj.members or {}).keys())
+
+    if config.get('merge_databases'):
+        merge_databases(sorted(set(projects)), ccm, config)
+
+def merge_databases(projects, ccm, config):
+    """Merge the relations of the projects and their members from all merge_databases at once"""
+    databases = SynergyDatabases(config['merge_databases'], channel=config.get('ccm_channel'))
+    for project in projects:
+        project_obj = ccm_cache.get_object(project, ccm)
+        names = [project] + (project_obj.members or {}).keys()
+        print "Merging %d objects of %s from %s" % (len(names), project, ', '.join(databases.get_database_names()))
+        ccm_cache.merge_database_info(names, databases)
 
 def populate_cache_with_project_and_members(project, ccm, ccmpool):
     print "Loading object %s" % project
@@ -71,10 +91,15 @@ def populate_cache_with_objects_from_project(project, ccm, ccmpool):
     project_obj = ccm_cache.get_object(project, ccm)
     if not project_obj.members:
         populate_cache_with_project_and_members(project, ccm, ccmpool)
+    else:
+        # Members missing from an earlier, interrupted run
+        ccm_cache.prefetch(project_obj.members.keys(), ccmpool)
 
 def start_sessions(config):
-    ccm = SynergySession(config['database'])
-    ccm_pool = SynergySessions(database=config['database'], nr_sessions=config['max_sessions'])
+    start_run(config)
+    channel = config.get('ccm_channel')
+    ccm = SynergySession(config['database'], channel=channel)
+    ccm_pool = SynergySessions(database=config['database'], nr_sessions=1, max_sessions=config['max_sessions'], channel=channel)
     return ccm, ccm_pool
 
 def main():
@@ -82,6 +107,7 @@ def main():
     logger.basicConfig(filename='populate.log',level=logger.DEBUG)
     config = load_config_file()
     populate_cache_with_projects(config)
+    finish_run(config)
 
 
 if __name__ == '__main__':
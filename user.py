@@ -20,11 +20,11 @@ FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.    IN NO EVENT SHALL THE COPYRI
 (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
 CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
-import cPickle
 import ldap
 import re
 from subprocess import Popen, PIPE
 import logging as logger
+from load_configuration import get_config
 
 class user(object):
     def __init__(self):
@@ -44,9 +44,7 @@ class user(object):
         return user
 
 def get_email_domain():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
+    config = get_config()
     try:
         domain = config['email_domain']
     except KeyError:
@@ -109,9 +107,7 @@ class ldap_user(object):
 
 
     def get_ldap_configuration(self):
-        f = open('config.p', 'rb')
-        config = cPickle.load(f)
-        f.close()
+        config = get_config()
         try:
             username = config['username']
             password = config['password']
@@ -124,9 +120,7 @@ class ldap_user(object):
 
 
 def get_finger_configuration():
-    f = open('config.p', 'rb')
-    config = cPickle.load(f)
-    f.close()
+    config = get_config()
     try:
         server = config['finger']['server']
     except KeyError: